@@ -11,6 +11,7 @@ from flask_babel import Babel, lazy_gettext as _l
 from opensearchpy import OpenSearch
 import logging
 import os
+import threading
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -39,7 +40,30 @@ def create_app(config_class=Config):
         if app.config["OPENSEARCH_URL"]
         else None
     )
-    print(app.opensearch.ping(), flush=True)
+    from app.search import IndexQueue, SearchCache, create_backend
+
+    app.search_backend = create_backend(app)
+    app.search_cache = SearchCache(
+        app.config["SEARCH_CACHE_SIZE"], app.config["SEARCH_CACHE_TTL"]
+    )
+    app.search_queue = IndexQueue(app)
+    from app.email import MailQueue
+
+    app.mail_queue = MailQueue(app)
+    from app.pubsub import create_broker
+
+    app.pubsub = create_broker(app)
+    app.notification_streams = threading.BoundedSemaphore(
+        app.config["NOTIFICATIONS_MAX_STREAMS"]
+    )
+    from app.cache import TokenCache
+
+    app.token_cache = TokenCache(
+        app.pubsub, app.config["TOKEN_CACHE_SIZE"], app.config["TOKEN_CACHE_TTL"]
+    )
+    from app.activity import LastSeenBuffer
+
+    app.last_seen = LastSeenBuffer(app)
     from app.errors import bp as errors_bp
 
     app.register_blueprint(errors_bp)
@@ -56,6 +80,10 @@ def create_app(config_class=Config):
 
     app.register_blueprint(api_bp, url_prefix="/api")
 
+    from app.services.language_service import warm_up
+
+    warm_up()
+
     if not app.debug and not app.testing:
         if app.config["MAIL_SERVER"]:
             auth = None
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+import atexit
+import threading
+import time
+from app import db
+from app.services.background import BackgroundThreads
+
+
+class LastSeenBuffer(object):
+    """Write-behind buffer for ``User.last_seen``.
+
+    Requests only record a timestamp in memory, and only when the stored
+    value is older than LAST_SEEN_THRESHOLD. A background thread writes
+    the buffer every LAST_SEEN_FLUSH_INTERVAL seconds in one bulk UPDATE
+    that never moves a timestamp backwards, so buffers in different
+    workers can be flushed in any order.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config["LAST_SEEN_FLUSH_INTERVAL"]
+        self.threshold = timedelta(seconds=app.config["LAST_SEEN_THRESHOLD"])
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.recorded = {}
+        self.worker = BackgroundThreads(self._run, name="last-seen")
+
+    def record(self, user, when=None):
+        when = when or datetime.utcnow()
+        with self.lock:
+            last = max(
+                filter(None, (user.last_seen, self.recorded.get(user.id))),
+                default=None,
+            )
+            if last is not None and when - last < self.threshold:
+                return
+            self.pending[user.id] = self.recorded[user.id] = when
+        if self.worker.ensure():
+            atexit.register(self._flush_in_context)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._flush_in_context()
+            except Exception:
+                self.app.logger.exception("Could not write last_seen updates")
+
+    def _flush_in_context(self):
+        with self.app.app_context():
+            self.flush()
+
+    def flush(self):
+        from app.models import User
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            cutoff = datetime.utcnow() - self.threshold
+            self.recorded = {
+                id: when for id, when in self.recorded.items() if when > cutoff
+            }
+        if not pending:
+            return 0
+        ts = db.bindparam("ts")
+        stmt = (
+            db.update(User.__table__)
+            .where(User.id == db.bindparam("uid"))
+            .where(db.or_(User.last_seen.is_(None), User.last_seen < ts))
+            .values(last_seen=ts, version=User.version + 1)
+        )
+        with db.engine.begin() as conn:
+            conn.execute(
+                stmt, [{"uid": id, "ts": when} for id, when in pending.items()]
+            )
+        return len(pending)
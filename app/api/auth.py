@@ -1,4 +1,6 @@
+from flask import abort, current_app
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
+from app import db
 from app.models import User
 from app.api.errors import error_response
 
@@ -18,9 +20,35 @@ def basic_auth_error(status):
     return error_response(status)
 
 
+class TokenUser(object):
+    """The user behind an API token.
+
+    Only the id is known after authentication; the row is loaded the
+    first time any other attribute is used, so handlers that just need
+    the id cost no query. If the row has been deleted while the token
+    was still cached, the token is dropped and the request fails as
+    unauthenticated.
+    """
+
+    def __init__(self, id, token):
+        self.id = id
+        self.token = token
+
+    def __getattr__(self, name):
+        user = self.__dict__.get("_user")
+        if user is None:
+            user = db.session.get(User, self.id)
+            if user is None:
+                current_app.token_cache.invalidate(self.token)
+                abort(token_auth_error(401))
+            self.__dict__["_user"] = user
+        return getattr(user, name)
+
+
 @token_auth.verify_token
 def verify_token(token):
-    return User.check_token(token) if token else None
+    user_id = User.check_token(token) if token else None
+    return TokenUser(user_id, token) if user_id is not None else None
 
 
 @token_auth.error_handler
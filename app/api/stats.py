@@ -0,0 +1,15 @@
+from flask import jsonify, current_app
+from app.api import bp
+from app.api.auth import token_auth
+
+
+@bp.route("/stats", methods=["GET"])
+@token_auth.login_required
+def get_stats():
+    return jsonify(
+        {
+            "search_cache": current_app.search_cache.stats(),
+            "mail": current_app.mail_queue.stats(),
+            "token_cache": current_app.token_cache.stats(),
+        }
+    )
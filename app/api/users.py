@@ -1,48 +1,149 @@
-from flask import jsonify, request, url_for, abort
+from flask import jsonify, request, url_for, abort, make_response
 from app import db
 from app.models import User
+from app.pagination import KeysetPage
 from app.api import bp
 from app.api.errors import bad_request
 from app.api.auth import token_auth
+import hashlib
+
+
+def requested_fields():
+    fields = request.args.get("fields")
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(",") if name.strip()}
+
+
+def conditional(build, *versions):
+    """Answer with 304 when the client's ETag still matches ``versions``.
+
+    The tag combines the given row versions with the query string, so
+    ``build`` only runs when the representation may have changed.
+    """
+    args = hashlib.sha1(request.query_string).hexdigest()[:12]
+    etag = "-".join(str(v) for v in versions) + "-" + args
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+def page_versions(query, page, cursor, per_page):
+    """Hash the ids and versions of the users on the requested page.
+
+    Only ``per_page`` narrow rows are read, so checking the tag costs no
+    more than the page itself; membership changes elsewhere in the list
+    are covered by ``user.follow_version``.
+    """
+    rows = query.with_entities(User.id, User.version)
+    if page is None:
+        rows = KeysetPage(
+            rows, [User.id], cursor, per_page, key=lambda row: (row.id,)
+        ).items
+    else:
+        rows = rows.limit(per_page).offset((page - 1) * per_page).all()
+    versions = repr([tuple(row) for row in rows]).encode("utf-8")
+    return hashlib.sha1(versions).hexdigest()[:12]
 
 
 @bp.route("/users/<int:id>", methods=["GET"])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    user = User.query.get_or_404(id)
+    return conditional(
+        lambda: user.to_dict(fields=requested_fields()), user.id, user.version
+    )
 
 
 @bp.route("/users", methods=["GET"])
 @token_auth.login_required
 def get_users():
-    page = request.args.get("page", 1, type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, "api.get_users")
+    if "ids" in request.args:
+        return get_users_by_id()
+    page = request.args.get("page", type=int)
+    cursor = request.args.get("cursor")
+    total = request.args.get("total", 0, type=int) == 1
+    per_page = max(1, min(request.args.get("per_page", 10, type=int), 100))
+    data = User.to_collection_dict(
+        User.query,
+        page,
+        per_page,
+        "api.get_users",
+        cursor=cursor,
+        include_total=total,
+        fields=requested_fields(),
+    )
     return jsonify(data)
 
 
+def get_users_by_id():
+    try:
+        ids = [int(id) for id in request.args["ids"].split(",") if id.strip()]
+    except ValueError:
+        return bad_request("ids must be a comma separated list of integers")
+    if len(ids) > 100:
+        return bad_request("at most 100 ids can be requested at once")
+    users = {u.id: u for u in User.query.filter(User.id.in_(ids))}
+    fields = requested_fields()
+    # in the order asked for; ids that do not exist are left out
+    items = [
+        users[id].to_dict(fields=fields) for id in dict.fromkeys(ids) if id in users
+    ]
+    return jsonify({"items": items})
+
+
 @bp.route("/users/<int:id>/followers", methods=["GET"])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
-    data = User.to_collection_dict(
-        user.followers, page, per_page, "api.get_followers", id=id
+    page = request.args.get("page", type=int)
+    cursor = request.args.get("cursor")
+    total = request.args.get("total", 0, type=int) == 1
+    per_page = max(1, min(request.args.get("per_page", 10, type=int), 100))
+    return conditional(
+        lambda: User.to_collection_dict(
+            user.followers,
+            page,
+            per_page,
+            "api.get_followers",
+            cursor=cursor,
+            include_total=total,
+            fields=requested_fields(),
+            id=id,
+        ),
+        user.id,
+        user.follow_version,
+        page_versions(user.followers, page, cursor, per_page),
     )
-    return jsonify(data)
 
 
 @bp.route("/users/<int:id>/followed", methods=["GET"])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
-    data = User.to_collection_dict(
-        user.followed, page, per_page, "api.get_followed", id=id
+    page = request.args.get("page", type=int)
+    cursor = request.args.get("cursor")
+    total = request.args.get("total", 0, type=int) == 1
+    per_page = max(1, min(request.args.get("per_page", 10, type=int), 100))
+    return conditional(
+        lambda: User.to_collection_dict(
+            user.followed,
+            page,
+            per_page,
+            "api.get_followed",
+            cursor=cursor,
+            include_total=total,
+            fields=requested_fields(),
+            id=id,
+        ),
+        user.id,
+        user.follow_version,
+        page_versions(user.followed, page, cursor, per_page),
     )
-    return jsonify(data)
 
 
 @bp.route("/users", methods=["POST"])
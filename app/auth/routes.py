@@ -12,7 +12,10 @@ from app.auth.forms import (
 )
 from app.models import User
 from app.auth.email import send_password_reset_email
-from app.services.profile_picture_service import gravatars, create_image_if_no_image
+from app.services.profile_picture_service import (
+    create_image_if_no_image,
+    provision_avatar_later,
+)
 
 @bp.route("/login", methods=["GET", "POST"])
 def login():
@@ -49,9 +52,7 @@ def register():
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
-        filename = gravatars(user.id)
-        user.uploaded_picture = filename
-        db.session.commit()
+        provision_avatar_later(user)
         flash(_("Congratulations, you are now a registered user!"))
         return redirect(url_for("auth.login"))
     return render_template("auth/register.html", title=_("Register"), form=form)
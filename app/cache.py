@@ -0,0 +1,97 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread-safe LRU mapping whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self.lock:
+            for key in [k for k in self.entries if predicate(k)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class TokenCache(TTLCache):
+    """Maps API tokens to ``(user id, expiration)``.
+
+    Entries are keyed by a hash of the token, and invalidations are
+    broadcast through ``broker`` so every worker drops them; the TTL
+    bounds how long a missed broadcast can leave an entry stale.
+    """
+
+    def __init__(self, broker, maxsize=4096, ttl=60):
+        super(TokenCache, self).__init__(maxsize, ttl)
+        self.broker = broker
+        broker.listen("tokens", lambda key, data: self.delete(key))
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def lookup(self, token, load):
+        """Return the cached entry for ``token``, calling ``load`` on a miss."""
+        # this worker must be polling to hear about other workers' revocations
+        self.broker.start()
+        key = self.key(token)
+        entry = self.get(key)
+        if entry is None:
+            entry = load(token)
+            if entry is not None:
+                self.set(key, entry)
+        return entry
+
+    def invalidate(self, token):
+        key = self.key(token)
+        self.delete(key)
+        self.broker.publish("tokens", key, None)
@@ -1,8 +1,32 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import click
+from app import db
+from app.models import Post, TimelineEntry, User
+from app.services.language_service import detect_text, warm_up
+from app.services.profile_picture_service import provision_missing_avatars
 
 
 def register(app):
+
+    def checkpoint_path(name):
+        os.makedirs(app.instance_path, exist_ok=True)
+        return os.path.join(app.instance_path, name + '.checkpoint')
+
+    def read_checkpoint(name):
+        try:
+            with open(checkpoint_path(name)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def write_checkpoint(name, value):
+        path = checkpoint_path(name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(value))
+        os.replace(path + '.tmp', path)
     
     @app.cli.group()
     def translate():
@@ -34,3 +58,186 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def timeline():
+        """Home timeline maintenance commands."""
+        pass
+
+    @timeline.command()
+    def rebuild():
+        """Rebuild every user's materialized timeline."""
+        TimelineEntry.rebuild()
+        db.session.commit()
+        click.echo('timeline rebuilt: {} entries'.format(
+            TimelineEntry.query.count()))
+
+
+    @app.cli.group()
+    def likes():
+        """Post like counter commands."""
+        pass
+
+    @likes.command('verify')
+    @click.option('--repair', is_flag=True, help='Fix any drift found.')
+    def verify_likes(repair):
+        """Compare Post.like_count against the post_like table."""
+        drift = Post.like_count_drift()
+        for id, stored, actual in drift:
+            click.echo('post {}: like_count={} actual={}'.format(
+                id, stored, actual))
+        if drift and repair:
+            Post.repair_like_counts(drift)
+            db.session.commit()
+            click.echo('repaired {} posts'.format(len(drift)))
+        elif not drift:
+            click.echo('like counts are consistent')
+
+    @app.cli.group()
+    def users():
+        """User counter commands."""
+        pass
+
+    @users.command('verify')
+    @click.option('--repair', is_flag=True, help='Fix any drift found.')
+    def verify_users(repair):
+        """Compare the post and follow counters against their tables."""
+        drift = User.social_count_drift()
+        for id, stored, actual in drift:
+            click.echo('user {}: posts/followers/followed={} actual={}'.format(
+                id, stored, actual))
+        if drift and repair:
+            User.repair_social_counts(drift)
+            db.session.commit()
+            click.echo('repaired {} users'.format(len(drift)))
+        elif not drift:
+            click.echo('user counters are consistent')
+
+    @app.cli.group()
+    def messages():
+        """Private message commands."""
+        pass
+
+    @messages.command()
+    def reconcile():
+        """Recount User.unread_message_count from the message table."""
+        drift = User.unread_message_drift()
+        for id, stored, actual in drift:
+            click.echo('user {}: unread_message_count={} actual={}'.format(
+                id, stored, actual))
+        if drift:
+            User.repair_unread_message_counts(drift)
+            db.session.commit()
+            click.echo('repaired {} users'.format(len(drift)))
+        else:
+            click.echo('unread message counts are consistent')
+
+    @app.cli.group()
+    def search():
+        """Full-text search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--batch-size', type=int, default=None,
+                  help='Documents per bulk request.')
+    @click.option('--workers', type=int, default=4,
+                  help='Concurrent bulk requests.')
+    @click.option('--restart', is_flag=True,
+                  help='Ignore the saved checkpoint and start from id 0.')
+    def reindex(batch_size, workers, restart):
+        """Rebuild the post index, resuming after the last indexed id."""
+        name = 'search-reindex-' + Post.__tablename__
+        start_id = 0 if restart else read_checkpoint(name)
+        if start_id:
+            click.echo('resuming after id {}'.format(start_id))
+        started = time.monotonic()
+        done = [0]
+
+        def on_chunk(last_id, size):
+            done[0] += size
+            write_checkpoint(name, last_id)
+            elapsed = time.monotonic() - started
+            click.echo('indexed {} docs up to id {} ({:.0f} docs/s)'.format(
+                done[0], last_id, done[0] / elapsed if elapsed else 0))
+
+        Post.reindex(start_id, batch_size, workers, on_chunk)
+        if os.path.exists(checkpoint_path(name)):
+            os.remove(checkpoint_path(name))
+        click.echo('reindex complete: {} docs in {:.1f}s'.format(
+            done[0], time.monotonic() - started))
+
+    @app.cli.group()
+    def posts():
+        """Post maintenance commands."""
+        pass
+
+    @posts.command('detect-language')
+    @click.option('--chunk-size', type=int, default=2000,
+                  help='Posts read and updated per round trip.')
+    @click.option('--workers', type=int, default=os.cpu_count(),
+                  help='Detector processes.')
+    @click.option('--restart', is_flag=True,
+                  help='Ignore the saved checkpoint and start from id 0.')
+    @click.option('--skip-undetected', is_flag=True,
+                  help="Leave posts stored as '' (undetectable) alone.")
+    def detect_language(chunk_size, workers, restart, skip_undetected):
+        """Backfill Post.language where it is NULL or ''.
+
+        Posts whose language could not be detected are stored as ''.
+        They are retried on every run unless --skip-undetected is given.
+        """
+        name = 'posts-detect-language'
+        last_id = 0 if restart else read_checkpoint(name)
+        if last_id:
+            click.echo('resuming after id {}'.format(last_id))
+        min_length = app.config['LANGUAGE_DETECT_MIN_LENGTH']
+        ascii_default = app.config['LANGUAGE_ASCII_DEFAULT']
+        started = time.monotonic()
+        done = 0
+        missing = Post.language.is_(None)
+        if not skip_undetected:
+            missing = db.or_(missing, Post.language == '')
+        with ProcessPoolExecutor(workers, initializer=warm_up) as pool:
+            while True:
+                rows = db.session.execute(
+                    db.select(Post.id, Post.body)
+                    .where(Post.id > last_id, missing)
+                    .order_by(Post.id)
+                    .limit(chunk_size)
+                ).all()
+                if not rows:
+                    break
+                languages = pool.map(
+                    detect_text, [body for _, body in rows],
+                    repeat(min_length), repeat(ascii_default),
+                    chunksize=max(len(rows) // (workers * 4), 1))
+                db.session.execute(db.update(Post), [
+                    {'id': id, 'language': language}
+                    for (id, _), language in zip(rows, languages)])
+                db.session.commit()
+                last_id = rows[-1][0]
+                write_checkpoint(name, last_id)
+                done += len(rows)
+                elapsed = time.monotonic() - started
+                click.echo('{} posts up to id {} ({:.0f} rows/s)'.format(
+                    done, last_id, done / elapsed if elapsed else 0))
+        if os.path.exists(checkpoint_path(name)):
+            os.remove(checkpoint_path(name))
+        click.echo('language backfill complete: {} posts in {:.1f}s'.format(
+            done, time.monotonic() - started))
+
+    @app.cli.group()
+    def avatars():
+        """Profile picture commands."""
+        pass
+
+    @avatars.command()
+    @click.option('--concurrency', type=int,
+                  default=app.config['AVATAR_CONCURRENCY'],
+                  help='Images generated in parallel.')
+    def provision(concurrency):
+        """Create avatars for every user who does not have one yet."""
+        started = time.monotonic()
+        done, failed = provision_missing_avatars(concurrency)
+        click.echo('provisioned {} avatars, {} failed, in {:.1f}s'.format(
+            done, failed, time.monotonic() - started))
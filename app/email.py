@@ -1,32 +1,138 @@
 from flask_mail import Message
-from flask import render_template, current_app
-from flask_babel import _
+from flask import current_app
 from app import mail
-from threading import Thread
+from app.services.background import BackgroundThreads
+from collections import deque
+import queue
+import smtplib
+import threading
+import time
+
+
+def _backoff(attempt):
+    time.sleep(min(2 ** attempt, 30))
 
-def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    mail.send(msg)
-
-def send_password_reset_email(user):
-    token = user.get_reset_password_token()
-    send_email(_('[Microblog] Reset Your Password'),
-               sender=app.config['ADMINS'][0],
-               recipients=[user.email],
-               text_body=render_template('email/reset_password.txt',
-                                         user=user, token=token),
-               html_body=render_template('email/reset_password.html',
-                                         user=user, token=token))
-
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app.get_current_object(), msg)).start()
+    return current_app.mail_queue.put(msg)
+
+
+class MailQueue(object):
+    """Sends email from a bounded queue with a fixed pool of workers.
+
+    Each worker keeps its SMTP connection open while there is mail to send
+    and closes it after MAIL_IDLE_TIMEOUT seconds without work. When the
+    queue is full, callers wait up to MAIL_ENQUEUE_TIMEOUT before the
+    message is rejected.
+    """
+
+    def __init__(self, app, max_retries=3):
+        self.app = app
+        self.workers = app.config["MAIL_WORKERS"]
+        self.batch_size = app.config["MAIL_BATCH_SIZE"]
+        self.enqueue_timeout = app.config["MAIL_ENQUEUE_TIMEOUT"]
+        self.idle_timeout = app.config["MAIL_IDLE_TIMEOUT"]
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=app.config["MAIL_QUEUE_SIZE"])
+        self.lock = threading.Lock()
+        self.threads = BackgroundThreads(self._run, count=self.workers, name="mail")
+        self.latencies = deque(maxlen=1000)
+        self.sent = self.failed = self.rejected = self.retries = 0
+
+    def put(self, msg):
+        self.threads.ensure()
+        try:
+            self.queue.put((msg, time.monotonic()), timeout=self.enqueue_timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            self.app.logger.warning("Mail queue full, dropping %r", msg.subject)
+            return False
+        return True
+
+    def _run(self):
+        conn = None
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout if conn else None)
+            except queue.Empty:
+                conn = self._close(conn)
+                continue
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                for msg, queued_at in batch:
+                    try:
+                        conn = self._send(conn, msg, queued_at)
+                    except Exception:
+                        # nothing may kill a worker: it would not be restarted
+                        # in this process and join() would never return
+                        self.app.logger.exception("Could not send %r", msg.subject)
+                        conn = self._close(conn)
+                        with self.lock:
+                            self.failed += 1
+                    finally:
+                        self.queue.task_done()
+
+    def _send(self, conn, msg, queued_at):
+        for attempt in range(self.max_retries + 1):
+            try:
+                if conn is None:
+                    # only keep the connection once it has been opened
+                    conn = mail.connect().__enter__()
+                conn.send(msg)
+            except (smtplib.SMTPException, OSError):
+                conn = self._close(conn)
+                if attempt == self.max_retries:
+                    self.app.logger.exception("Could not send %r", msg.subject)
+                    with self.lock:
+                        self.failed += 1
+                    return conn
+                with self.lock:
+                    self.retries += 1
+                _backoff(attempt)
+            except Exception:
+                # a malformed message will not get better by retrying
+                self.app.logger.exception("Could not send %r", msg.subject)
+                with self.lock:
+                    self.failed += 1
+                return conn
+            else:
+                with self.lock:
+                    self.sent += 1
+                    self.latencies.append(time.monotonic() - queued_at)
+                return conn
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def join(self):
+        """Block until every queued message has been sent or given up on."""
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                "depth": self.queue.qsize(),
+                "maxsize": self.queue.maxsize,
+                "workers": self.workers,
+                "sent": self.sent,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "retries": self.retries,
+                "latency_avg": sum(latencies) / len(latencies) if latencies else None,
+                "latency_max": latencies[-1] if latencies else None,
+            }
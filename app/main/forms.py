@@ -9,7 +9,7 @@ from app.models import User
 
 class EditProfileForm(FlaskForm):
     # is there a wtforms size validator for files?
-    profile_picture = FileField("Upload a profile picture", validators=[FileAllowed(['jpg', 'jpeg', 'png', 'gif'])])
+    profile_picture = FileField("Upload a profile picture", validators=[FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'])])
     username = StringField(_l("Username"), validators=[DataRequired()])
     about_me = TextAreaField(_l("About me"), validators=[Length(min=0, max=140)])
     submit = SubmitField(_l("Submit"))
@@ -1,4 +1,3 @@
-from datetime import datetime
 from flask import (
     render_template,
     flash,
@@ -9,25 +8,48 @@ from flask import (
     jsonify,
     current_app,
     send_from_directory,
+    make_response,
+    abort,
+    Response,
 )
 from flask_login import current_user, login_required, logout_user
 from flask_babel import _, get_locale
-from langdetect import detect, LangDetectException
+from werkzeug.utils import safe_join
 from app import db
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification
-from app.translate import translate
+from app.models import User, Post, Message, Notification, TimelineEntry
+from app.pagination import KeysetPage
+from app.translate import translate, translate_batch, configured
 from app.main import bp
 
 from app.services.misc_service import delete_stranded_posts, delete_stranded_user_images
-from werkzeug.utils import secure_filename
+from app.services.language_service import detect_language, detect_language_later
+from app.services.profile_picture_service import set_uploaded_avatar
+import json
 import os
+import queue
+import re
+import time
+
+
+def page_urls(endpoint, page, **kwargs):
+    next_url = (
+        url_for(endpoint, cursor=page.next_cursor, **kwargs) if page.has_next else None
+    )
+    prev_url = (
+        url_for(endpoint, cursor=page.prev_cursor, **kwargs) if page.has_prev else None
+    )
+    return next_url, prev_url
+
+
+def like_state(posts):
+    return {"liked": current_user.liked_post_ids(posts)}
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
+        current_app.last_seen.record(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -36,24 +58,24 @@ def before_request():
 @bp.route("/index", methods=["GET", "POST"])
 @login_required
 def index():
-    Post.reindex()
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ""
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
+        if not current_app.config["LANGUAGE_DETECT_ASYNC"]:
+            post.language = detect_language(post.body)
         db.session.add(post)
         db.session.commit()
+        if post.language is None:
+            detect_language_later(post)
         flash(_("Your post is now live!"))
         return redirect(url_for("main.index"))
-    page = request.args.get("page", 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
+    posts = KeysetPage(
+        current_user.followed_posts(),
+        [TimelineEntry.timestamp, TimelineEntry.post_id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
     )
-    next_url = url_for("main.index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.index", page=posts.prev_num) if posts.has_prev else None
+    next_url, prev_url = page_urls("main.index", posts)
     return render_template(
         "index.html",
         title=_("Home"),
@@ -61,24 +83,27 @@ def index():
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
+        **like_state(posts.items)
     )
 
 
 @bp.route("/explore")
 @login_required
 def explore():
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
+    posts = KeysetPage(
+        Post.query,
+        [Post.timestamp, Post.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
     )
-    next_url = url_for("main.explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.explore", page=posts.prev_num) if posts.has_prev else None
+    next_url, prev_url = page_urls("main.explore", posts)
     return render_template(
         "index.html",
         title=_("Explore"),
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
+        **like_state(posts.items)
     )
 
 
@@ -86,20 +111,13 @@ def explore():
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
-    )
-    next_url = (
-        url_for("main.user", username=user.username, page=posts.next_num)
-        if posts.has_next
-        else None
-    )
-    prev_url = (
-        url_for("main.user", username=user.username, page=posts.prev_num)
-        if posts.has_prev
-        else None
+    posts = KeysetPage(
+        user.posts,
+        [Post.timestamp, Post.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
     )
+    next_url, prev_url = page_urls("main.user", posts, username=user.username)
     form = EmptyForm()
     return render_template(
         "user.html",
@@ -108,6 +126,7 @@ def user(username):
         next_url=next_url,
         prev_url=prev_url,
         form=form,
+        **like_state(posts.items)
     )
 
 
@@ -116,21 +135,14 @@ def user(username):
 def edit_profile(username):
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
-        filename = secure_filename(form.profile_picture.data.filename)
-        if filename:
-            if current_user.uploaded_picture:
-                print(current_user.uploaded_picture)
-                filepath = os.path.join(current_app.root_path, "static", "profile_pictures", current_user.uploaded_picture)
-                os.remove(filepath)
-            if "gravatar" in filename:  # change to if user chose default option
-                filename = "user" + str(current_user.id) + ".png"
-            else:
-                filename = "user" + str(current_user.id) + "." + filename.split(".")[-1]
-            profile_picture_url = os.path.join(
-                current_app.root_path, "static", "profile_pictures", filename
-            )
-            form.profile_picture.data.save(profile_picture_url)
-            current_user.uploaded_picture = filename
+        if form.profile_picture.data and form.profile_picture.data.filename:
+            try:
+                set_uploaded_avatar(current_user, form.profile_picture.data.stream)
+            except ValueError:
+                flash(_("That file is not a usable image."))
+                return render_template(
+                    "edit_profile.html", title=_("Edit Profile"), form=form
+                )
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
@@ -145,8 +157,27 @@ def edit_profile(username):
 @bp.route("/profile_pictures/<path:filename>")
 @login_required
 def profile_pictures(filename):
-    path = os.path.join(current_app.root_path, "static", "profile_pictures")
-    return send_from_directory(path, filename)
+    # names are hashes of the image, so a URL's bytes never change
+    immutable = re.fullmatch(r"[0-9a-f]{24}_\d+\.webp", filename) is not None
+    max_age = current_app.config["AVATAR_CACHE_MAX_AGE"] if immutable else 0
+    prefix = current_app.config["AVATAR_X_ACCEL_PREFIX"]
+    if prefix:
+        if safe_join(prefix, filename) is None:
+            abort(404)
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = safe_join(prefix, filename)
+        # let nginx pick the type from the file it serves
+        del response.headers["Content-Type"]
+    else:
+        path = os.path.join(current_app.root_path, "static", "profile_pictures")
+        response = send_from_directory(path, filename, max_age=max_age)
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 
 @bp.route("/delete/<int:id>")
@@ -172,22 +203,19 @@ def delete_user(id):
 @login_required
 def followers(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
+    followers = KeysetPage(
+        user.followers,
+        [User.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
+        key=lambda u: (u.id,),
     )
-    followers = []
-    for u in User.query:
-        if user.followed_by(u):
-            followers.append(u)
-    print("followers: ", followers)
-    next_url = url_for("main.followers", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.followers", page=posts.prev_num) if posts.has_prev else None
+    next_url, prev_url = page_urls("main.followers", followers, username=username)
     return render_template(
         "followers.html",
         title=_("Followers"),
         user=user,
-        followers=followers,
+        followers=followers.items,
         next_url=next_url,
         prev_url=prev_url,
     )
@@ -197,22 +225,19 @@ def followers(username):
 @login_required
 def following(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
+    followings = KeysetPage(
+        user.followed,
+        [User.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
+        key=lambda u: (u.id,),
     )
-    followings = []
-    for u in User.query:
-        if user.is_following(u):
-            followings.append(u)
-    print("followings: ", followings)
-    next_url = url_for("main.following", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.following", page=posts.prev_num) if posts.has_prev else None
+    next_url, prev_url = page_urls("main.following", followings, username=username)
     return render_template(
         "following.html",
-        title=_("Followers"),
+        title=_("Following"),
         user=user,
-        followings=followings,
+        followings=followings.items,
         next_url=next_url,
         prev_url=prev_url,
     )
@@ -301,6 +326,39 @@ def translate_text():
     )
 
 
+@bp.route("/translate/batch", methods=["POST"])
+@login_required
+def translate_posts():
+    data = request.get_json(silent=True) or {}
+    dest_language = data.get("dest_language") or g.locale
+    ids = data.get("post_ids", [])
+    if not isinstance(ids, list) or not all(
+        isinstance(id, int) and not isinstance(id, bool) for id in ids
+    ):
+        return jsonify({"error": _("post_ids must be a list of integers.")}), 400
+    if dest_language not in current_app.config["LANGUAGES"]:
+        return jsonify({"error": _("Unsupported language.")}), 400
+    ids = ids[:100]
+    if not configured():
+        message = _("Error: the translation service is not configured.")
+        return jsonify({"error": message}), 503
+    posts = [
+        post
+        for post in Post.query.filter(Post.id.in_(ids))
+        if post.language and post.language != dest_language
+    ]
+    translations = translate_batch(
+        [(post.body, post.language) for post in posts], dest_language
+    )
+    return jsonify(
+        {
+            "translations": {
+                post.id: text for post, text in zip(posts, translations) if text
+            }
+        }
+    )
+
+
 @bp.route("/search")
 @login_required
 def search():
@@ -310,6 +368,7 @@ def search():
     posts, total = Post.search(
         g.search_form.q.data, page, current_app.config["POSTS_PER_PAGE"]
     )
+    posts = posts.all()
     next_url = (
         url_for("main.search", q=g.search_form.q.data, page=page + 1)
         if total > page * current_app.config["POSTS_PER_PAGE"]
@@ -326,6 +385,7 @@ def search():
         posts=posts,
         next_url=next_url,
         prev_url=prev_url,
+        **like_state(posts)
     )
 
 
@@ -345,7 +405,7 @@ def send_message(recipient):
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        user.add_notification("unread_message_count", user.new_messages())
+        user.add_notification("unread_message_count", user.receive_message())
         db.session.commit()
         flash(_("Your message has been sent."))
         return redirect(url_for("main.user", username=recipient))
@@ -357,21 +417,16 @@ def send_message(recipient):
 @bp.route("/messages")
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
+    current_user.read_messages()
     current_user.add_notification("unread_message_count", 0)
     db.session.commit()
-    page = request.args.get("page", 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()
-    ).paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
-    )
-    next_url = (
-        url_for("main.messages", page=messages.next_num) if messages.has_next else None
-    )
-    prev_url = (
-        url_for("main.messages", page=messages.prev_num) if messages.has_prev else None
+    messages = KeysetPage(
+        current_user.messages_received,
+        [Message.timestamp, Message.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
     )
+    next_url, prev_url = page_urls("main.messages", messages)
     return render_template(
         "messages.html", messages=messages.items, next_url=next_url, prev_url=prev_url
     )
@@ -384,9 +439,53 @@ def notifications():
     notifications = current_user.notifications.filter(
         Notification.timestamp > since
     ).order_by(Notification.timestamp.asc())
-    return jsonify(
-        [
-            {"name": n.name, "data": n.get_data(), "timestamp": n.timestamp}
-            for n in notifications
-        ]
+    return jsonify([n.to_dict() for n in notifications])
+
+
+@bp.route("/notifications/stream")
+@login_required
+def notification_stream():
+    """Push the current user's notifications as server-sent events.
+
+    The stream ends after NOTIFICATIONS_STREAM_TIMEOUT seconds and the
+    browser reconnects with Last-Event-ID, which replays anything missed.
+    Streams are meant to be served by a gevent worker (see deployment/),
+    where an open stream only holds a greenlet. Each process still serves
+    at most NOTIFICATIONS_MAX_STREAMS; beyond that the request gets a 503
+    and the page polls until it retries the stream.
+    """
+    slots = current_app.notification_streams
+    if not slots.acquire(blocking=False):
+        response = jsonify({"error": "too many notification streams"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "60"
+        return response
+    broker = current_app.pubsub
+    user_id = current_user.id
+    heartbeat = current_app.config["NOTIFICATIONS_HEARTBEAT"]
+    deadline = time.monotonic() + current_app.config["NOTIFICATIONS_STREAM_TIMEOUT"]
+    since = request.headers.get("Last-Event-ID", type=int)
+    events = broker.subscribe("notifications", user_id, since)
+
+    def generate():
+        yield "retry: 5000\n\n"
+        while time.monotonic() < deadline:
+            try:
+                id, payload = events.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield "id: {}\ndata: {}\n\n".format(id, json.dumps(payload))
+
+    def close():
+        # runs even if the client went away before the body was started
+        broker.unsubscribe("notifications", user_id, events)
+        slots.release()
+
+    response = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+    response.call_on_close(close)
+    return response
@@ -1,3 +1,5 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from time import time
 from flask import current_app, url_for
@@ -8,7 +10,21 @@ import json
 import base64
 import os
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import bulk_index, index_action, query_index
+from app.pagination import KeysetPage
+
+
+def discard_on_rollback(*keys):
+    """Return an ``after_soft_rollback`` listener that drops ``keys`` from
+    ``session.info``, where changes wait to be acted on after commit."""
+
+    def after_rollback(session, previous_transaction):
+        # a rolled back savepoint leaves the outer transaction's changes
+        if not previous_transaction.nested:
+            for key in keys:
+                session.info.pop(key, None)
+
+    return after_rollback
 
 
 class SearchableMixin(object):
@@ -26,34 +42,62 @@ class SearchableMixin(object):
         )
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            "add": list(session.new),
-            "update": list(session.dirty),
-            "delete": list(session.deleted),
-        }
+    def after_flush(cls, session, flush_context):
+        changes = session.info.setdefault("search_changes", set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, SearchableMixin):
+                changes.add((type(obj), obj.id))
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes["add"]:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["update"]:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["delete"]:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        changes = session.info.pop("search_changes", ())
+        for index in {model.__tablename__ for model, _ in changes}:
+            current_app.search_cache.invalidate(index)
+        for model, id in changes:
+            current_app.search_queue.put(model, id)
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
-
-
-db.event.listen(db.session, "before_commit", SearchableMixin.before_commit)
+    def reindex(cls, start_id=0, batch_size=None, workers=1, on_chunk=None):
+        """Bulk-index every row with ``id > start_id`` in id order.
+
+        Chunks are sent by a pool of ``workers`` threads; ``on_chunk`` is
+        called with the last id and size of each chunk, strictly in id
+        order, once that chunk and all chunks before it have been indexed.
+        """
+        batch_size = batch_size or current_app.config["SEARCH_BATCH_SIZE"]
+        backend = current_app.search_backend
+        query = cls.query.filter(cls.id > start_id).order_by(cls.id)
+        pending = deque()
+
+        def complete(block):
+            while pending and (block or pending[0][2].done()):
+                last_id, size, future = pending.popleft()
+                future.result()
+                if on_chunk:
+                    on_chunk(last_id, size)
+                block = False
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            chunk = []
+            for obj in query.yield_per(batch_size):
+                chunk.append(index_action(cls.__tablename__, obj))
+                if len(chunk) == batch_size:
+                    future = pool.submit(bulk_index, chunk, backend)
+                    pending.append((obj.id, len(chunk), future))
+                    chunk = []
+                    complete(len(pending) > 2 * workers)
+            if chunk:
+                future = pool.submit(bulk_index, chunk, backend)
+                pending.append((chunk[-1]["_id"], len(chunk), future))
+            while pending:
+                complete(True)
+
+
+db.event.listen(db.session, "after_flush", SearchableMixin.after_flush)
 db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
+db.event.listen(
+    db.session, "after_soft_rollback", discard_on_rollback("search_changes")
+)
 
 
 followers = db.Table(
@@ -64,11 +108,19 @@ followers = db.Table(
 
 
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, cursor=None,
+                           include_total=False, fields=None, **kwargs):
+        if page is None:
+            return cls._to_cursor_dict(
+                query, cursor, per_page, endpoint, include_total, fields, **kwargs
+            )
+        if fields:
+            # keep the field selection on the pagination links
+            kwargs["fields"] = ",".join(sorted(fields))
         resources = query.paginate(page=page, per_page=per_page, error_out=False)
         data = {
-            "items": [item.to_dict() for item in resources.items],
+            "items": [item.to_dict(fields=fields) for item in resources.items],
             "_meta": {
                 "page": page,
                 "per_page": per_page,
@@ -87,6 +139,39 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @classmethod
+    def _to_cursor_dict(cls, query, cursor, per_page, endpoint, include_total,
+                        fields=None, **kwargs):
+        resources = KeysetPage(
+            query, [cls.id], cursor, per_page, key=lambda item: (item.id,),
+            count=include_total,
+        )
+        if include_total:
+            kwargs["total"] = 1
+        if fields:
+            kwargs["fields"] = ",".join(sorted(fields))
+        meta = {"per_page": per_page}
+        if include_total:
+            meta["total_items"] = resources.total
+            meta["total_pages"] = -(-resources.total // per_page)
+        return {
+            "items": [item.to_dict(fields=fields) for item in resources.items],
+            "_meta": meta,
+            "_links": {
+                "self": url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                "next": url_for(
+                    endpoint, cursor=resources.next_cursor, per_page=per_page, **kwargs
+                )
+                if resources.has_next
+                else None,
+                "prev": url_for(
+                    endpoint, cursor=resources.prev_cursor, per_page=per_page, **kwargs
+                )
+                if resources.has_prev
+                else None,
+            },
+        }
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -122,7 +207,23 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         backref="recipient",
         lazy="dynamic"
     )
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    follower_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    followed_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    # bumped whenever the API representation changes, for ETags
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # bumped whenever this user's followers or followed users change
+    follow_version = db.Column(
+        db.Integer, nullable=False, default=1, server_default="1"
+    )
     last_message_read_time = db.Column(db.DateTime)
+    unread_message_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
     notifications = db.relationship("Notification", backref="user", lazy="dynamic")
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
@@ -136,17 +237,52 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-    @property
-    def avatar(self):
-       return url_for('main.profile_pictures', filename=self.uploaded_picture)
+    def avatar(self, size=128):
+        if not self.uploaded_picture:
+            return url_for('static', filename='avatar_placeholder.png')
+        if "." in self.uploaded_picture:
+            # uploaded before size variants existed
+            return url_for('main.profile_pictures', filename=self.uploaded_picture)
+        sizes = current_app.config["AVATAR_SIZES"]
+        size = next((s for s in sizes if s >= size), sizes[-1])
+        return url_for('main.profile_pictures',
+                       filename="{}_{}.webp".format(self.uploaded_picture, size))
+
+    def avatar_filenames(self):
+        if not self.uploaded_picture:
+            return []
+        if "." in self.uploaded_picture:
+            return [self.uploaded_picture]
+        return ["{}_{}.webp".format(self.uploaded_picture, size)
+                for size in current_app.config["AVATAR_SIZES"]]
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            TimelineEntry.backfill(self, user)
+            self._count_follow(user, 1)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            TimelineEntry.prune(self, user)
+            self._count_follow(user, -1)
+
+    def _count_follow(self, user, delta):
+        User.query.filter_by(id=self.id).update(
+            {
+                User.followed_count: User.followed_count + delta,
+                User.version: User.version + 1,
+                User.follow_version: User.follow_version + 1,
+            }
+        )
+        User.query.filter_by(id=user.id).update(
+            {
+                User.follower_count: User.follower_count + delta,
+                User.version: User.version + 1,
+                User.follow_version: User.follow_version + 1,
+            }
+        )
 
     def is_following(self, user):
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
@@ -155,11 +291,11 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return self.followers.filter(followers.c.followed_id != user.id).count() > 0
 
     def followed_posts(self):
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)
-        ).filter(followers.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return (
+            Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id)
+            .filter(TimelineEntry.user_id == self.id)
+            .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc())
+        )
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -176,6 +312,106 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             .count()
         )
 
+    def receive_message(self):
+        """Count one more unread message, in SQL so concurrent sends add up."""
+        User.query.filter_by(id=self.id).update(
+            {User.unread_message_count: User.unread_message_count + 1}
+        )
+        return self.unread_message_count
+
+    def read_messages(self):
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_message_count = 0
+
+    @staticmethod
+    def unread_message_drift():
+        last_read = db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1))
+        actual = (
+            db.select(db.func.count(Message.id))
+            .where(Message.recipient_id == User.id, Message.timestamp > last_read)
+            .scalar_subquery()
+        )
+        return db.session.execute(
+            db.select(User.id, User.unread_message_count, actual)
+            .where(User.unread_message_count != actual)
+            .order_by(User.id)
+        ).all()
+
+    @staticmethod
+    def repair_unread_message_counts(drift):
+        if drift:
+            db.session.execute(
+                db.update(User),
+                [{"id": id, "unread_message_count": unread} for id, _, unread in drift],
+            )
+
+    @staticmethod
+    def social_count_drift():
+        """Return ``(id, stored, actual)`` for users whose counters are off.
+
+        ``stored`` and ``actual`` are ``(posts, followers, followed)``.
+        """
+        def count(column, where):
+            return (
+                db.select(db.func.count()).select_from(column.table)
+                .where(where == User.id).scalar_subquery()
+            )
+
+        actual = (
+            count(Post.id, Post.user_id),
+            count(followers.c.follower_id, followers.c.followed_id),
+            count(followers.c.followed_id, followers.c.follower_id),
+        )
+        stored = (User.post_count, User.follower_count, User.followed_count)
+        rows = db.session.execute(
+            db.select(User.id, *stored, *actual)
+            .where(db.or_(*[s != a for s, a in zip(stored, actual)]))
+            .order_by(User.id)
+        ).all()
+        return [(row[0], tuple(row[1:4]), tuple(row[4:7])) for row in rows]
+
+    @staticmethod
+    def repair_social_counts(drift):
+        if drift:
+            db.session.execute(
+                db.update(User).values(version=User.version + 1),
+                [
+                    {"id": id, "post_count": posts, "follower_count": followers,
+                     "followed_count": followed}
+                    for id, _, (posts, followers, followed) in drift
+                ],
+            )
+
+    @classmethod
+    def count_posts(cls, session, flush_context):
+        deltas = {}
+        for obj in session.new:
+            if isinstance(obj, Post):
+                deltas[obj.user_id] = deltas.get(obj.user_id, 0) + 1
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                deltas[obj.user_id] = deltas.get(obj.user_id, 0) - 1
+        for user_id, delta in deltas.items():
+            if user_id is None or delta == 0:
+                continue
+            session.connection().execute(
+                db.update(cls)
+                .where(cls.id == user_id)
+                .values(post_count=cls.post_count + delta, version=cls.version + 1)
+            )
+            key = db.inspect(cls).identity_key_from_primary_key((user_id,))
+            user = session.identity_map.get(key)
+            if user is not None:
+                session.expire(user, ["post_count", "version"])
+
+    @classmethod
+    def bump_versions(cls, session, flush_context, instances):
+        for obj in session.dirty:
+            if isinstance(obj, cls) and session.is_modified(
+                obj, include_collections=False
+            ):
+                obj.version = cls.version + 1
+
     def add_notification(self, name, data):
         self.notifications.filter_by(name=name).delete()
         n = Notification(name=name, payload_json=json.dumps(data), user=self)
@@ -192,25 +428,35 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return
         return User.query.get(id)
 
-    def to_dict(self, include_email=False):
-        data = {
-            "id": self.id,
-            "username": self.username,
-            "last_seen": self.last_seen.isoformat() + "Z",
-            "about_me": self.about_me,
-            "post_count": self.posts.count(),
-            "follower_count": self.followers.count(),
-            "followed_count": self.followed.count(),
-            "avatar": self.avatar,
-            "_links": {
+    def to_dict(self, include_email=False, fields=None):
+        """Serialize for the API.
+
+        ``fields`` restricts the output to those names (``id`` is always
+        included); fields that are not asked for are never computed.
+        """
+        getters = {
+            "id": lambda: self.id,
+            "username": lambda: self.username,
+            "last_seen": lambda: self.last_seen.isoformat() + "Z",
+            "about_me": lambda: self.about_me,
+            "post_count": lambda: self.post_count,
+            "follower_count": lambda: self.follower_count,
+            "followed_count": lambda: self.followed_count,
+            "avatar": lambda: self.avatar(128),
+            "_links": lambda: {
                 "self": url_for("api.get_user", id=self.id),
                 "followers": url_for("api.get_followers", id=self.id),
                 "followed": url_for("api.get_followed", id=self.id),
             },
         }
         if include_email:
-            data["email"] = self.email
-        return data
+            getters["email"] = lambda: self.email
+        if fields:
+            getters = {
+                name: get for name, get in getters.items()
+                if name == "id" or name in fields
+            }
+        return {name: get() for name, get in getters.items()}
 
     def from_dict(self, data, new_user=False):
         for field in ["username", "email", "about_me"]:
@@ -223,6 +469,7 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
+        self._forget_token()
         self.token = base64.b64encode(os.urandom(24)).decode("utf-8")
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
@@ -230,17 +477,45 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        self._forget_token()
+
+    def _forget_token(self):
+        # dropped from the token cache once the change is committed
+        if self.token:
+            db.session.info.setdefault("stale_tokens", set()).add(self.token)
 
     @staticmethod
     def check_token(token):
-        user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+        """Return the id of the user owning ``token`` if it has not expired.
+
+        Lookups go through the token cache, and a miss only reads the id
+        and expiration columns.
+        """
+        def load(token):
+            row = db.session.execute(
+                db.select(User.id, User.token_expiration).where(User.token == token)
+            ).first()
+            return tuple(row) if row is not None else None
+
+        entry = current_app.token_cache.lookup(token, load)
+        if entry is None or entry[1] < datetime.utcnow():
             return None
-        return user
+        return entry[0]
+
+    @classmethod
+    def after_commit(cls, session):
+        for token in session.info.pop("stale_tokens", ()):
+            current_app.token_cache.invalidate(token)
     
     def delete(self):
-        filepath = os.path.join(current_app.root_path, "static", "profile_pictures", self.uploaded_picture)
-        os.remove(filepath)
+        # avatars are content-addressed, so another user may share the files
+        shared = User.query.filter(
+            User.uploaded_picture == self.uploaded_picture, User.id != self.id
+        ).count()
+        for filename in [] if shared else self.avatar_filenames():
+            filepath = os.path.join(current_app.root_path, "static", "profile_pictures", filename)
+            if os.path.exists(filepath):
+                os.remove(filepath)
         for p in self.posts:
             db.session.delete(p)
         for p in self.followed:
@@ -256,18 +531,31 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         if not self.has_liked_post(post):
             like = PostLike(user_id=self.id, post_id=post.id)
             db.session.add(like)
+            Post.query.filter_by(id=post.id).update(
+                {Post.like_count: Post.like_count + 1})
 
     def unlike_post(self, post):
         if self.has_liked_post(post):
-            PostLike.query.filter_by(
+            removed = PostLike.query.filter_by(
                 user_id=self.id,
                 post_id=post.id).delete()
+            Post.query.filter_by(id=post.id).update(
+                {Post.like_count: Post.like_count - removed})
 
     def has_liked_post(self, post):
         return PostLike.query.filter(
             PostLike.user_id == self.id,
             PostLike.post_id == post.id).count() > 0
 
+    def liked_post_ids(self, posts):
+        ids = [p.id for p in posts]
+        if not ids:
+            return set()
+        rows = db.session.query(PostLike.post_id).filter(
+            PostLike.user_id == self.id,
+            PostLike.post_id.in_(ids))
+        return {post_id for post_id, in rows}
+
 
 @login.user_loader
 def load_user(id):
@@ -282,15 +570,149 @@ class Post(SearchableMixin, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     language = db.Column(db.String(5))
     likes = db.relationship("PostLike", backref='post', lazy='dynamic')
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     def __repr__(self):
         return "<Post {}>".format(self.body)
+
+    @staticmethod
+    def like_count_drift():
+        actual = (
+            db.select(PostLike.post_id, db.func.count(PostLike.id).label("likes"))
+            .group_by(PostLike.post_id)
+            .subquery()
+        )
+        likes = db.func.coalesce(actual.c.likes, 0)
+        return db.session.execute(
+            db.select(Post.id, Post.like_count, likes)
+            .outerjoin(actual, actual.c.post_id == Post.id)
+            .where(Post.like_count != likes)
+            .order_by(Post.id)
+        ).all()
+
+    @staticmethod
+    def repair_like_counts(drift):
+        if drift:
+            db.session.execute(
+                db.update(Post),
+                [{"id": id, "like_count": likes} for id, _, likes in drift],
+            )
     
     def delete_post(self):
         db.session.delete(self)
         db.session.commit()
 
 
+class TimelineEntry(db.Model):
+    """Materialized home timeline, one row per (reader, post).
+
+    Rows are written when a post is flushed (fan-out on write) and when a
+    follow is created, and pruned on unfollow or post deletion, so that
+    ``User.followed_posts`` is a single indexed range scan.
+    """
+
+    __tablename__ = "timeline_entry"
+    __table_args__ = (
+        db.Index("ix_timeline_entry_user_timestamp", "user_id", "timestamp"),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    @staticmethod
+    def _readers(author_id):
+        own = db.select(db.literal(author_id).label("user_id"))
+        fans = db.select(followers.c.follower_id).where(
+            followers.c.followed_id == author_id
+        )
+        # union, not union_all: an author may follow themselves
+        return own.union(fans).subquery()
+
+    @classmethod
+    def fan_out(cls, connection, post):
+        if post.user_id is None:
+            return
+        readers = cls._readers(post.user_id)
+        connection.execute(
+            db.insert(cls).from_select(
+                ["user_id", "post_id", "timestamp"],
+                db.select(
+                    readers.c.user_id,
+                    db.literal(post.id),
+                    db.literal(post.timestamp, db.DateTime),
+                ),
+            )
+        )
+
+    @classmethod
+    def backfill(cls, follower, followed):
+        if follower.id == followed.id:
+            # a user's own posts are always in their timeline
+            return
+        db.session.execute(
+            db.insert(cls).from_select(
+                ["user_id", "post_id", "timestamp"],
+                db.select(db.literal(follower.id), Post.id, Post.timestamp).where(
+                    Post.user_id == followed.id
+                ),
+            )
+        )
+
+    @classmethod
+    def prune(cls, follower, followed):
+        if follower.id == followed.id:
+            return
+        db.session.execute(
+            db.delete(cls).where(
+                cls.user_id == follower.id,
+                cls.post_id.in_(
+                    db.select(Post.id).where(Post.user_id == followed.id)
+                ),
+            )
+        )
+
+    @classmethod
+    def rebuild(cls):
+        db.session.execute(db.delete(cls))
+        posts = Post.__table__
+        own = db.select(posts.c.user_id, posts.c.id, posts.c.timestamp).where(
+            posts.c.user_id.isnot(None)
+        )
+        fans = db.select(followers.c.follower_id, posts.c.id, posts.c.timestamp).join(
+            followers, followers.c.followed_id == posts.c.user_id
+        )
+        db.session.execute(
+            db.insert(cls).from_select(
+                ["user_id", "post_id", "timestamp"], own.union(fans)
+            )
+        )
+
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        posts = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+        users = [obj.id for obj in session.deleted if isinstance(obj, User)]
+        if posts:
+            session.connection().execute(db.delete(cls).where(cls.post_id.in_(posts)))
+        if users:
+            session.connection().execute(db.delete(cls).where(cls.user_id.in_(users)))
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        for obj in session.new:
+            if isinstance(obj, Post):
+                cls.fan_out(session.connection(), obj)
+
+
+db.event.listen(db.session, "after_flush", User.count_posts)
+db.event.listen(db.session, "before_flush", User.bump_versions)
+db.event.listen(db.session, "after_commit", User.after_commit)
+db.event.listen(
+    db.session, "after_soft_rollback", discard_on_rollback("stale_tokens")
+)
+db.event.listen(db.session, "before_flush", TimelineEntry.before_flush)
+db.event.listen(db.session, "after_flush", TimelineEntry.after_flush)
+
+
 class PostLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -308,6 +730,21 @@ class Message(db.Model):
         return "<Message {}>".format(self.body)
 
 
+class Translation(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint("text_hash", "source_language", "dest_language"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    text_hash = db.Column(db.String(64), nullable=False)
+    source_language = db.Column(db.String(5), nullable=False)
+    dest_language = db.Column(db.String(5), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<Translation {}>".format(self.text)
+
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
@@ -317,3 +754,29 @@ class Notification(db.Model):
 
     def get_data(self):
         return json.loads(str(self.payload_json))
+
+    def to_dict(self):
+        return {"name": self.name, "data": self.get_data(), "timestamp": self.timestamp}
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        events = session.info.setdefault("notification_events", [])
+        for obj in session.new:
+            if isinstance(obj, Notification):
+                events.append((obj.user_id, obj.to_dict()))
+
+    @classmethod
+    def after_commit(cls, session):
+        for user_id, payload in session.info.pop("notification_events", ()):
+            try:
+                current_app.pubsub.publish("notifications", user_id, payload)
+            except Exception:
+                # clients still catch up by polling, so never fail the commit
+                current_app.logger.exception("Could not publish notification")
+
+
+db.event.listen(db.session, "after_flush", Notification.after_flush)
+db.event.listen(db.session, "after_commit", Notification.after_commit)
+db.event.listen(
+    db.session, "after_soft_rollback", discard_on_rollback("notification_events")
+)
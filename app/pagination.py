@@ -0,0 +1,109 @@
+import base64
+import json
+from datetime import datetime
+from app import db
+
+
+def encode_cursor(values, direction):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps({"k": values, "d": direction}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_value(column, value):
+    # cursors come from clients, so a value must match its column's type
+    if value is None:
+        return None
+    if isinstance(column.type, db.DateTime):
+        if not isinstance(value, str):
+            raise TypeError(value)
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, db.Integer):
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise TypeError(value)
+        return value
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+
+def decode_cursor(cursor, columns):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        direction = data["d"]
+        values = data["k"]
+        if (
+            direction not in ("next", "prev")
+            or not isinstance(values, list)
+            or len(values) != len(columns)
+        ):
+            return None
+        values = [_decode_value(col, v) for col, v in zip(columns, values)]
+    except (ValueError, TypeError, KeyError):
+        return None
+    return values, direction
+
+
+def _after(columns, values, older):
+    # row-value comparison spelled out so it works on every backend
+    clauses = []
+    for i, (col, value) in enumerate(zip(columns, values)):
+        prefix = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(db.and_(*prefix, col < value if older else col > value))
+    return db.or_(*clauses)
+
+
+class KeysetPage(object):
+    """One page of a query ordered newest-first on ``columns``.
+
+    ``key`` maps a result row to the values of ``columns`` so that cursors
+    can be built from the first and last rows on the page.
+    """
+
+    def __init__(self, query, columns, cursor=None, per_page=10, key=None,
+                 count=False):
+        self.per_page = per_page
+        self.key = key or (lambda item: (item.timestamp, item.id))
+        decoded = decode_cursor(cursor, columns) if cursor else None
+        if decoded is None:
+            order = [c.desc() for c in columns]
+            rows = query.order_by(None).order_by(*order).limit(per_page + 1).all()
+            self.has_next = len(rows) > per_page
+            self.has_prev = False
+            self.items = rows[:per_page]
+        else:
+            values, direction = decoded
+            older = direction == "next"
+            order = [c.desc() if older else c.asc() for c in columns]
+            rows = (
+                query.filter(_after(columns, values, older))
+                .order_by(None)
+                .order_by(*order)
+                .limit(per_page + 1)
+                .all()
+            )
+            more = len(rows) > per_page
+            rows = rows[:per_page]
+            if older:
+                self.items = rows
+                self.has_next, self.has_prev = more, True
+            else:
+                self.items = list(reversed(rows))
+                self.has_next, self.has_prev = True, more
+        if not self.items:
+            self.has_next = self.has_prev = False
+        self.total = query.order_by(None).count() if count else None
+
+    @property
+    def next_cursor(self):
+        if not self.has_next:
+            return None
+        return encode_cursor(self.key(self.items[-1]), "next")
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev:
+            return None
+        return encode_cursor(self.key(self.items[0]), "prev")
+
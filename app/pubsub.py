@@ -0,0 +1,138 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from app.services.background import BackgroundThreads
+
+
+class Broker(object):
+    """Publish/subscribe between processes through a shared SQLite file.
+
+    Publishers append rows to an ``event`` table. One poller thread per
+    process reads the new rows and hands them to the local subscribers of
+    each ``(channel, key)``, so the cost of waiting does not grow with the
+    number of connected clients and never touches the application database.
+    """
+
+    def __init__(self, path, poll_interval=0.5, retention=300):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.listeners = {}
+        self.conn = None
+        self.pid = None
+        self.poller = BackgroundThreads(self._run, name="pubsub")
+        self.last_id = 0
+
+    def _connect(self):
+        # an SQLite connection must not be used across a fork, so each
+        # process opens its own and starts its own poller
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.conn = sqlite3.connect(
+                self.path, timeout=10, check_same_thread=False, isolation_level=None
+            )
+            if self.path != ":memory:":
+                self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS event (id INTEGER PRIMARY KEY "
+                "AUTOINCREMENT, channel TEXT, key TEXT, payload TEXT, created REAL)"
+            )
+            self.last_id = self.conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM event"
+            ).fetchone()[0]
+            self.poller.ensure()
+        return self.conn
+
+    def publish(self, channel, key, data):
+        with self.lock:
+            self._connect().execute(
+                "INSERT INTO event (channel, key, payload, created) VALUES (?, ?, ?, ?)",
+                (channel, str(key), json.dumps(data), time.time()),
+            )
+
+    def subscribe(self, channel, key, since=None):
+        """Return a queue receiving ``(event id, data)`` for ``channel``/``key``.
+
+        With ``since``, events still retained after that id are replayed
+        first, so a client that reconnects does not miss anything.
+        """
+        q = queue.Queue()
+        with self.lock:
+            conn = self._connect()
+            self.subscribers.setdefault((channel, str(key)), set()).add(q)
+            if since is not None:
+                rows = conn.execute(
+                    "SELECT id, payload FROM event WHERE id > ? AND id <= ? "
+                    "AND channel = ? AND key = ? ORDER BY id",
+                    (since, self.last_id, channel, str(key)),
+                )
+                for id, payload in rows:
+                    q.put((id, json.loads(payload)))
+        return q
+
+    def listen(self, channel, callback):
+        """Run ``callback(key, data)`` for every event on ``channel``.
+
+        Callbacks run on the poller thread of each process that has
+        started the broker, and must not call back into it.
+        """
+        with self.lock:
+            self.listeners.setdefault(channel, []).append(callback)
+
+    def start(self):
+        # called on every API request: skip the lock once this process is
+        # running, as the poller can hold it while SQLite waits on a lock
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            self._connect()
+
+    def unsubscribe(self, channel, key, q):
+        with self.lock:
+            queues = self.subscribers.get((channel, str(key)), set())
+            queues.discard(q)
+            if not queues:
+                self.subscribers.pop((channel, str(key)), None)
+
+    def _run(self):
+        last_prune = 0
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                try:
+                    self._poll()
+                    if time.time() - last_prune > self.retention:
+                        last_prune = time.time()
+                        self.conn.execute(
+                            "DELETE FROM event WHERE created < ?",
+                            (last_prune - self.retention,),
+                        )
+                except sqlite3.Error:
+                    # e.g. the file is locked by another worker; try again
+                    continue
+
+    def _poll(self):
+        rows = self.conn.execute(
+            "SELECT id, channel, key, payload FROM event WHERE id > ? ORDER BY id",
+            (self.last_id,),
+        ).fetchall()
+        for id, channel, key, payload in rows:
+            self.last_id = id
+            data = json.loads(payload)
+            for q in self.subscribers.get((channel, key), ()):
+                q.put((id, data))
+            for callback in self.listeners.get(channel, ()):
+                callback(key, data)
+
+
+def create_broker(app):
+    path = app.config["PUBSUB_PATH"]
+    if path != ":memory:" and not os.path.isabs(path):
+        os.makedirs(app.instance_path, exist_ok=True)
+        path = os.path.join(app.instance_path, path)
+    return Broker(path, app.config["PUBSUB_POLL_INTERVAL"])
@@ -1,32 +1,267 @@
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import sqlalchemy as sa
 from flask import current_app
+from opensearchpy.helpers import bulk
+from app import db
+from app.cache import TTLCache
+from app.services.background import BackgroundThreads
 
 
-def add_to_index(index, model):
-    if not current_app.opensearch:
-        return
+def index_action(index, model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    # current_app.opensearch.index(index=index, id=model.id, body=payload)
+    return {"_op_type": "index", "_index": index, "_id": model.id, "_source": payload}
+
+
+def delete_action(index, id):
+    return {"_op_type": "delete", "_index": index, "_id": id}
 
 
-def remove_from_index(index, model):
-    if not current_app.opensearch:
+def bulk_index(actions, backend=None):
+    backend = backend or current_app.search_backend
+    if not backend or not actions:
         return
-    current_app.opensearch.delete(index=index, id=model.id)
+    backend.bulk(actions)
+
+
+def _backoff(attempt):
+    time.sleep(min(2 ** attempt, 30))
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.opensearch:
+    if not current_app.search_backend:
         return [], 0
-    # print(current_app.opensearch.search())
-    search = current_app.opensearch.search(
-        index=index,
-        body={
-            "query": {"multi_match": {"query": query, "lenient": True, "fields": ["*"]}},
-            "from": (page - 1) * per_page,
-            "size": per_page,
-        },
-    )
-    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
-    return ids, search["hits"]["total"]["value"]
+    cache = current_app.search_cache
+    # take the key (and so the index version) before querying, so a result
+    # that races with an invalidation is stored under the old version
+    key = cache.key(index, query, page, per_page)
+    result = cache.get(key)
+    if result is None:
+        result = current_app.search_backend.query(index, query, page, per_page)
+        cache.set(key, result)
+    return result
+
+
+class SearchCache(TTLCache):
+    """Bounded LRU of search results with a TTL.
+
+    Keys include a per-index version that is bumped whenever that index
+    changes, so stale pages are never served after a write; the TTL only
+    bounds how long other workers' writes can go unnoticed.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        super(SearchCache, self).__init__(maxsize, ttl)
+        self.versions = {}
+        self.invalidations = 0
+
+    def key(self, index, query, page, per_page):
+        query = " ".join(query.lower().split())
+        with self.lock:
+            return (index, self.versions.get(index, 0), query, page, per_page)
+
+    def invalidate(self, index):
+        with self.lock:
+            self.versions[index] = self.versions.get(index, 0) + 1
+            self.delete_where(lambda key: key[0] == index)
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            stats = super(SearchCache, self).stats()
+            stats["invalidations"] = self.invalidations
+            return stats
+
+
+class OpenSearchBackend(object):
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, actions):
+        bulk(self.client, actions, ignore_status=(404,))
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            body={
+                "query": {
+                    "multi_match": {"query": query, "lenient": True, "fields": ["*"]}
+                },
+                "from": (page - 1) * per_page,
+                "size": per_page,
+            },
+        )
+        ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
+        return ids, search["hits"]["total"]["value"]
+
+
+class SQLiteFTSBackend(object):
+    """Local full-text index in an SQLite FTS5 database, ranked by BM25.
+
+    Each search index is an FTS5 table whose rowid is the model id, created
+    on first write from the searchable fields. The index lives in its own
+    file so it works the same whatever database the application uses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn = None
+        self.pid = None
+
+    @property
+    def conn(self):
+        # an SQLite connection must not be used across a fork (gunicorn
+        # --preload), so each process opens its own on first use
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            if self.path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+        return self._conn
+
+    def _tables(self):
+        rows = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        return {name for name, in rows}
+
+    def bulk(self, actions):
+        with self.lock, self.conn:
+            tables = self._tables()
+            for action in actions:
+                table = '"{}"'.format(action["_index"])
+                if action["_index"] not in tables:
+                    if action["_op_type"] != "index":
+                        continue
+                    self.conn.execute(
+                        "CREATE VIRTUAL TABLE {} USING fts5({})".format(
+                            table, ", ".join(action["_source"])
+                        )
+                    )
+                    tables.add(action["_index"])
+                self.conn.execute(
+                    "DELETE FROM {} WHERE rowid = ?".format(table), (action["_id"],)
+                )
+                if action["_op_type"] == "index":
+                    fields = list(action["_source"])
+                    self.conn.execute(
+                        "INSERT INTO {} (rowid, {}) VALUES (?, {})".format(
+                            table, ", ".join(fields), ", ".join("?" * len(fields))
+                        ),
+                        [action["_id"]] + [action["_source"][f] for f in fields],
+                    )
+
+    def query(self, index, query, page, per_page):
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return [], 0
+        expression = " OR ".join('"{}"'.format(term) for term in terms)
+        table = '"{}"'.format(index)
+        with self.lock:
+            if index not in self._tables():
+                return [], 0
+            total = self.conn.execute(
+                "SELECT COUNT(*) FROM {0} WHERE {0} MATCH ?".format(table),
+                (expression,),
+            ).fetchone()[0]
+            rows = self.conn.execute(
+                "SELECT rowid FROM {0} WHERE {0} MATCH ? "
+                "ORDER BY bm25({0}) LIMIT ? OFFSET ?".format(table),
+                (expression, per_page, (page - 1) * per_page),
+            )
+            ids = [id for id, in rows]
+        return ids, total
+
+
+def create_backend(app):
+    if app.opensearch:
+        return OpenSearchBackend(app.opensearch)
+    path = app.config["SEARCH_FTS_PATH"]
+    if not path:
+        return None
+    if path != ":memory:" and not os.path.isabs(path):
+        os.makedirs(app.instance_path, exist_ok=True)
+        path = os.path.join(app.instance_path, path)
+    return SQLiteFTSBackend(path)
+
+
+class IndexQueue(object):
+    """Buffers changed searchable rows and indexes them in the background.
+
+    Only ``(model class, id)`` pairs are queued; the worker thread reloads
+    the rows in one query per batch and sends a single bulk request, so
+    the request that committed the change never waits on OpenSearch.
+    """
+
+    def __init__(self, app, max_retries=5):
+        self.app = app
+        self.batch_size = app.config["SEARCH_BATCH_SIZE"]
+        self.flush_interval = app.config["SEARCH_FLUSH_INTERVAL"]
+        self.max_retries = max_retries
+        self.queue = queue.Queue()
+        self.worker = BackgroundThreads(self._run, name="search-index")
+
+    def put(self, cls, id):
+        if not self.app.search_backend:
+            return
+        if not self.app.config["SEARCH_INDEX_ASYNC"]:
+            self.flush([(cls, id)])
+            return
+        self.queue.put((cls, id))
+        self.worker.ensure()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                self._flush_with_retry(batch)
+
+    def _flush_with_retry(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.flush(batch)
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    self.app.logger.exception(
+                        "Dropping %d search index updates", len(batch)
+                    )
+                    return
+                _backoff(attempt)
+
+    def flush(self, batch):
+        actions = []
+        by_class = {}
+        for cls, id in batch:
+            by_class.setdefault(cls, set()).add(id)
+        # a private session, so this is safe to run from a commit hook
+        session = sa.orm.Session(db.engine)
+        try:
+            for cls, ids in by_class.items():
+                rows = session.scalars(sa.select(cls).where(cls.id.in_(ids)))
+                found = {obj.id: obj for obj in rows}
+                for id in ids:
+                    obj = found.get(id)
+                    if obj is None:
+                        actions.append(delete_action(cls.__tablename__, id))
+                    else:
+                        actions.append(index_action(cls.__tablename__, obj))
+        finally:
+            session.close()
+        bulk_index(actions, self.app.search_backend)
+        for cls in by_class:
+            self.app.search_cache.invalidate(cls.__tablename__)
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def executor(name, max_workers=2):
+    """Return a shared thread pool, recreated after a fork.
+
+    Threads do not survive ``fork``, so a pool created in the gunicorn
+    master (e.g. with --preload) is replaced the first time a worker uses it.
+    """
+    with _lock:
+        pool, pid = _executors.get(name, (None, None))
+        if pool is None or pid != os.getpid():
+            pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            _executors[name] = (pool, os.getpid())
+        return pool
+
+
+class BackgroundThreads(object):
+    """Daemon threads running ``target``, started lazily once per process.
+
+    For the same reason as :func:`executor`, threads started before a
+    fork are gone in the child; :meth:`ensure` starts ``count`` fresh ones
+    the first time it is called in each process.
+    """
+
+    def __init__(self, target, count=1, name=None):
+        self.target = target
+        self.count = count
+        self.name = name
+        self.lock = threading.Lock()
+        self.threads = []
+        self.pid = None
+
+    def ensure(self):
+        """Start the threads if needed; return True if they were started."""
+        with self.lock:
+            if self.pid == os.getpid():
+                return False
+            self.pid = os.getpid()
+            self.threads = [
+                threading.Thread(target=self.target, name=self.name, daemon=True)
+                for _ in range(self.count)
+            ]
+            for thread in self.threads:
+                thread.start()
+            return True
@@ -0,0 +1,55 @@
+from app import db
+from app.models import Post
+from app.services.background import executor
+from flask import current_app
+from langdetect import DetectorFactory, detect, LangDetectException
+from langdetect.detector_factory import init_factory
+
+
+def warm_up():
+    # load every language profile now, so that with gunicorn --preload the
+    # workers share them copy-on-write instead of each loading its own
+    DetectorFactory.seed = 0
+    init_factory()
+
+
+def detect_text(text, min_length=0, ascii_default=None):
+    text = (text or "").strip()
+    if len(text) < max(min_length, 1):
+        return ""
+    if ascii_default and text.isascii():
+        return ascii_default
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ""
+
+
+def detect_language(text):
+    return detect_text(
+        text,
+        current_app.config["LANGUAGE_DETECT_MIN_LENGTH"],
+        current_app.config["LANGUAGE_ASCII_DEFAULT"],
+    )
+
+
+def _detect_and_save(app, post_id, text):
+    with app.app_context():
+        try:
+            db.session.execute(
+                db.update(Post)
+                .where(Post.id == post_id)
+                .values(language=detect_language(text))
+            )
+            db.session.commit()
+        except Exception:
+            app.logger.exception("Language detection failed for post %s", post_id)
+        finally:
+            db.session.remove()
+
+
+def detect_language_later(post):
+    """Fill in ``post.language`` from a background thread."""
+    executor("language").submit(
+        _detect_and_save, current_app._get_current_object(), post.id, post.body
+    )
@@ -19,7 +19,7 @@ def delete_stranded_user_images():
         all_images.append(f)
     for u in users_with_images:
         print("image currently in use: ", u.uploaded_picture)
-        used_images.append(u.uploaded_picture)
+        used_images.extend(u.avatar_filenames())
     for i in all_images:
         if i not in used_images and i != ".DS_Store":
             print("deleting ", i)
@@ -1,41 +1,211 @@
 from app import db
 from app.models import User
-from hashlib import md5
+from app.services.background import executor
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import md5, sha256
 from flask import current_app
-import requests
-import shutil
+from io import BytesIO
+from PIL import Image, ImageOps
+import colorsys
 import os
+import struct
+import zlib
 
+BACKGROUND = (240, 240, 240)
 
-def gravatars(id):
-    print("in gravatars")
-    new_filename = "user" + str(id) + ".png"
-    new_path = os.path.join(
-        current_app.root_path, "static", "profile_pictures", new_filename
+
+def _png(width, height, rows):
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(
+            ">I", zlib.crc32(body) & 0xFFFFFFFF
+        )
+
+    raw = b"".join(b"\x00" + row for row in rows)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
     )
+
+
+@lru_cache(maxsize=1024)
+def render_identicon(digest, size=256):
+    """Render a 5x5 mirrored identicon PNG for a hex ``digest``.
+
+    The pattern and colour are derived only from the digest, so the same
+    user always gets the same image and results can be cached by digest.
+    """
+    hue = int(digest[-7:], 16) / 0xFFFFFFF
+    lightness = 0.45 + (int(digest[-9:-7], 16) / 255) * 0.15
+    color = bytes(
+        int(c * 255) for c in colorsys.hls_to_rgb(hue, lightness, 0.6)
+    )
+    background = bytes(BACKGROUND)
+    cells = [[False] * 5 for _ in range(5)]
+    for i in range(15):
+        row, col = i % 5, i // 5
+        cells[row][col] = cells[row][4 - col] = int(digest[i], 16) % 2 == 0
+    cell = size // 6
+    margin = (size - cell * 5) // 2
+    rows = []
+    blank = background * size
+    for y in range(size):
+        grid_y = (y - margin) // cell
+        if y < margin or grid_y >= 5:
+            rows.append(blank)
+            continue
+        line = [background * margin]
+        for on in cells[grid_y]:
+            line.append((color if on else background) * cell)
+        line.append(background * (size - margin - cell * 5))
+        rows.append(b"".join(line))
+    return _png(size, size, rows)
+
+
+def picture_path(filename):
+    return os.path.join(current_app.root_path, "static", "profile_pictures", filename)
+
+
+def load_image(stream):
+    """Open and validate an uploaded image, raising ValueError if unusable."""
+    try:
+        image = Image.open(stream)
+        if image.width * image.height > current_app.config["AVATAR_MAX_PIXELS"]:
+            raise ValueError("image is too large")
+        image.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError("not a valid image") from e
+    image = ImageOps.exif_transpose(image)
+    return image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+
+def save_avatar(image):
+    """Store square WebP variants of ``image`` for every AVATAR_SIZES entry.
+
+    Files are named after a hash of the cropped image, so a URL always
+    refers to the same bytes and can be cached forever. Returns the stem.
+    """
+    side = min(image.size)
+    image = ImageOps.fit(image, (side, side), Image.LANCZOS)
+    digest = sha256(image.mode.encode("ascii") + image.tobytes())
+    stem = digest.hexdigest()[:24]
+    for size in current_app.config["AVATAR_SIZES"]:
+        path = picture_path("{}_{}.webp".format(stem, size))
+        if os.path.exists(path):
+            continue
+        variant = image.resize((size, size), Image.LANCZOS) if size != side else image
+        variant.save(
+            path + ".tmp", "WEBP", quality=current_app.config["AVATAR_QUALITY"]
+        )
+        os.replace(path + ".tmp", path)
+    return stem
+
+
+def delete_avatar_files(user, name):
+    """Remove the files for picture ``name`` unless another user shares them."""
+    shared = User.query.filter(
+        User.uploaded_picture == name, User.id != user.id
+    ).count()
+    if not name or shared:
+        return
+    for filename in User(uploaded_picture=name).avatar_filenames():
+        if os.path.exists(picture_path(filename)):
+            os.remove(picture_path(filename))
+
+
+def set_uploaded_avatar(user, stream):
+    image = load_image(stream)
+    old = user.uploaded_picture
+    user.uploaded_picture = save_avatar(image)
+    if old != user.uploaded_picture:
+        delete_avatar_files(user, old)
+
+
+def generate_identicon(id):
+    """Write the identicon variants for user ``id`` and return their stem."""
     digest = md5(str(id).lower().encode("utf-8")).hexdigest()
-    url = "https://www.gravatar.com/avatar/{}?d=identicon&s={}".format(digest, 256)
-    data = requests.get(url, stream=True)
-    if data.status_code == 200:
-        with open(new_path, "wb") as f:
-            data.raw.decode_content = True
-            shutil.copyfileobj(data.raw, f)
-    print("gravatars finished, new_filename: ", new_filename)
-    return new_filename
+    size = max(current_app.config["AVATAR_SIZES"])
+    return save_avatar(Image.open(BytesIO(render_identicon(digest, size))))
+
+
+def convert_legacy_avatar(user):
+    """Transcode a pre-variant upload into sized variants; return the stem."""
+    with open(picture_path(user.uploaded_picture), "rb") as f:
+        return save_avatar(load_image(f))
 
 
 def update_db():
-    users = User.query.filter_by(uploaded_picture=None)
-    for user in users:
-        filename = "user" + str(user.id) + ".png"
-        print(filename)
-        print(user)
-        user.uploaded_picture = filename
-    db.session.commit()
+    provision_missing_avatars()
+
+
+def has_image(user):
+    filenames = user.avatar_filenames()
+    return bool(filenames) and all(os.path.isfile(picture_path(f)) for f in filenames)
+
+
+def is_legacy(user):
+    return has_image(user) and "." in user.uploaded_picture
+
+
+def _provision(app, user_id):
+    with app.app_context():
+        try:
+            filename = generate_identicon(user_id)
+            if filename:
+                db.session.execute(
+                    db.update(User)
+                    .where(User.id == user_id)
+                    .values(uploaded_picture=filename, version=User.version + 1)
+                )
+                db.session.commit()
+        except Exception:
+            app.logger.exception("Avatar provisioning failed for user %s", user_id)
+        finally:
+            db.session.remove()
+
+
+def provision_avatar_later(user):
+    """Create ``user``'s avatar in the background; a placeholder shows until then."""
+    pool = executor("avatars", current_app.config["AVATAR_CONCURRENCY"])
+    pool.submit(_provision, current_app._get_current_object(), user.id)
 
 
 def create_image_if_no_image(user):
-    if not os.path.isfile(os.path.join(current_app.root_path, "static", "profile_pictures", user.uploaded_picture)):
-        filename = gravatars(user.id)
-        user.uploaded_picture = filename
-        db.session.commit()
\ No newline at end of file
+    if not has_image(user):
+        provision_avatar_later(user)
+
+
+def provision_missing_avatars(concurrency=4):
+    """Generate every missing avatar using ``concurrency`` threads.
+
+    Uploads stored before size variants existed are transcoded as well.
+    Returns ``(provisioned, failed)`` counts.
+    """
+    users = [user for user in User.query if is_legacy(user) or not has_image(user)]
+    app = current_app._get_current_object()
+
+    def generate(user):
+        with app.app_context():
+            try:
+                if is_legacy(user):
+                    return user.id, convert_legacy_avatar(user)
+                return user.id, generate_identicon(user.id)
+            except (OSError, ValueError):
+                app.logger.exception("Could not create avatar for user %s", user.id)
+                return user.id, None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(generate, users))
+    done = [
+        {"id": user_id, "uploaded_picture": filename}
+        for user_id, filename in results
+        if filename
+    ]
+    if done:
+        # the avatar URL is part of the API representation, so bump the ETag
+        db.session.execute(db.update(User).values(version=User.version + 1), done)
+        db.session.commit()
+    return len(done), len(results) - len(done)
@@ -1,27 +1,159 @@
-import json
+import hashlib
+import os
+from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 from flask_babel import _
-from app import current_app, mail
+from sqlalchemy.exc import IntegrityError
+from app import current_app, db
+from app.cache import TTLCache
+from app.models import Translation
 
+_session = None
+_session_pid = None
+_memory = None
 
-def translate(text, source_language, dest_language):
-    if (
-        "MS_TRANSLATOR_KEY" not in current_app.config
-        or not current_app.config["MS_TRANSLATOR_KEY"]
-    ):
-        return _("Error: the translation service is not configured.")
+
+def http_session():
+    """Return this process's pooled session for the translator API."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=current_app.config["TRANSLATOR_POOL_SIZE"],
+        )
+        _session.mount("https://", adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def memory_cache():
+    global _memory
+    if _memory is None:
+        _memory = TTLCache(
+            current_app.config["TRANSLATION_CACHE_SIZE"],
+            current_app.config["TRANSLATION_CACHE_TTL"],
+        )
+    return _memory
+
+
+def cache_key(text, source_language, dest_language):
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return digest, source_language, dest_language
+
+
+def cached_translation(key):
+    text = memory_cache().get(key)
+    if text is not None:
+        return text
+    ttl = timedelta(seconds=current_app.config["TRANSLATION_CACHE_TTL"])
+    row = Translation.query.filter_by(
+        text_hash=key[0], source_language=key[1], dest_language=key[2]
+    ).first()
+    if row is None or row.timestamp < datetime.utcnow() - ttl:
+        return None
+    memory_cache().set(key, row.text)
+    return row.text
+
+
+def store_translation(key, text, commit=True):
+    memory_cache().set(key, text)
+    updated = Translation.query.filter_by(
+        text_hash=key[0], source_language=key[1], dest_language=key[2]
+    ).update({"text": text, "timestamp": datetime.utcnow()})
+    if not updated:
+        try:
+            with db.session.begin_nested():
+                db.session.add(
+                    Translation(
+                        text_hash=key[0],
+                        source_language=key[1],
+                        dest_language=key[2],
+                        text=text,
+                    )
+                )
+        except IntegrityError:
+            # another request stored the same translation first; theirs is
+            # as good as ours, and ours is already in the memory cache
+            pass
+    if commit:
+        db.session.commit()
+
+
+def configured():
+    return bool(current_app.config.get("MS_TRANSLATOR_KEY"))
+
+
+def request_translations(texts, dest_language, source_language=None):
+    """Translate ``texts`` in one upstream call, or return None on failure.
+
+    Without ``source_language`` the service detects each text's language.
+    """
     auth = {
         "Ocp-Apim-Subscription-Key": current_app.config["MS_TRANSLATOR_KEY"],
         "Ocp-Apim-Subscription-Region": "westus2",
     }
-    r = requests.post(
-        "https://api.cognitive.microsofttranslator.com"
-        "/translate?api-version=3.0&from={}&to={}".format(
-            source_language, dest_language
-        ),
-        headers=auth,
-        json=[{"Text": text}],
-    )
+    params = {"api-version": "3.0", "to": dest_language}
+    if source_language:
+        params["from"] = source_language
+    try:
+        r = http_session().post(
+            "https://api.cognitive.microsofttranslator.com/translate",
+            params=params,
+            headers=auth,
+            json=[{"Text": text} for text in texts],
+            timeout=current_app.config["TRANSLATOR_TIMEOUT"],
+        )
+    except requests.RequestException:
+        return None
     if r.status_code != 200:
+        return None
+    return [item["translations"][0]["text"] for item in r.json()]
+
+
+def translate(text, source_language, dest_language):
+    if not configured():
+        return _("Error: the translation service is not configured.")
+    key = cache_key(text, source_language, dest_language)
+    cached = cached_translation(key)
+    if cached is not None:
+        return cached
+    translations = request_translations([text], dest_language, source_language)
+    if translations is None:
         return _("Error: the translation service failed.")
-    return r.json()[0]["translations"][0]["text"]
+    store_translation(key, translations[0])
+    return translations[0]
+
+
+def translate_batch(items, dest_language):
+    """Translate a list of ``(text, source_language)`` pairs.
+
+    Duplicates are collapsed and cache hits answered locally; the remaining
+    texts go upstream in as few requests as TRANSLATOR_BATCH_SIZE allows.
+    Returns a list aligned with ``items`` holding None where translation
+    failed.
+    """
+    keys = [cache_key(text, source, dest_language) for text, source in items]
+    results = {}
+    misses = {}
+    for key, (text, source) in zip(keys, items):
+        if key in results or key in misses:
+            continue
+        cached = cached_translation(key)
+        if cached is not None:
+            results[key] = cached
+        else:
+            misses[key] = text
+    misses = list(misses.items())
+    size = current_app.config["TRANSLATOR_BATCH_SIZE"]
+    for start in range(0, len(misses), size):
+        chunk = misses[start:start + size]
+        translations = request_translations([text for key, text in chunk], dest_language)
+        if translations is None:
+            continue
+        for (key, text), translation in zip(chunk, translations):
+            results[key] = translation
+            store_translation(key, translation, commit=False)
+    db.session.commit()
+    return [results.get(key) for key in keys]
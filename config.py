@@ -15,9 +15,51 @@ class Config(object):
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_BATCH_SIZE = 20
+    MAIL_ENQUEUE_TIMEOUT = 5
+    MAIL_IDLE_TIMEOUT = 30
     ADMINS = ['jiff@example.com']
+    # relative to the instance folder; every worker must see the same file
+    PUBSUB_PATH = os.environ.get('PUBSUB_PATH') or 'pubsub.db'
+    PUBSUB_POLL_INTERVAL = 0.5
+    NOTIFICATIONS_HEARTBEAT = 15
+    NOTIFICATIONS_STREAM_TIMEOUT = 300
+    # per worker process. Under a threaded worker each stream holds a thread,
+    # so keep this well below --threads; the gevent stream server in
+    # deployment/ raises it, since an idle stream there costs a greenlet
+    NOTIFICATIONS_MAX_STREAMS = int(os.environ.get('NOTIFICATIONS_MAX_STREAMS') or 4)
+    TOKEN_CACHE_SIZE = 4096
+    TOKEN_CACHE_TTL = 60
     LANGUAGES = ['en', 'ko']
+    LANGUAGE_DETECT_ASYNC = True
+    LANGUAGE_DETECT_MIN_LENGTH = 8
+    # language assumed for pure-ASCII posts; None always runs the detector
+    LANGUAGE_ASCII_DEFAULT = 'en'
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_TIMEOUT = (3.05, 10)
+    TRANSLATOR_POOL_SIZE = 10
+    TRANSLATOR_BATCH_SIZE = 100
+    TRANSLATION_CACHE_SIZE = 4096
+    TRANSLATION_CACHE_TTL = 30 * 24 * 3600
     OPENSEARCH_URL = os.environ.get('OPENSEARCH_URL')
+    SEARCH_BATCH_SIZE = int(os.environ.get('SEARCH_BATCH_SIZE') or 500)
+    SEARCH_FLUSH_INTERVAL = float(os.environ.get('SEARCH_FLUSH_INTERVAL') or 1.0)
+    SEARCH_INDEX_ASYNC = True
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)
+    # used when OPENSEARCH_URL is unset; relative to the instance folder
+    SEARCH_FTS_PATH = os.environ.get('SEARCH_FTS_PATH', 'search.db')
+    LAST_SEEN_FLUSH_INTERVAL = 30
+    LAST_SEEN_THRESHOLD = 60
     POSTS_PER_PAGE = 10
+    AVATAR_CONCURRENCY = 4
+    AVATAR_SIZES = (64, 128, 256)
+    AVATAR_QUALITY = 80
+    AVATAR_MAX_PIXELS = 40 * 1000 * 1000
+    AVATAR_CACHE_MAX_AGE = 365 * 24 * 3600
+    # e.g. /_protected_profile_pictures to let nginx send the files
+    AVATAR_X_ACCEL_PREFIX = os.environ.get("AVATAR_X_ACCEL_PREFIX")
+    MAX_CONTENT_LENGTH = 8 * 1024 * 1024
     # STATIC_URL_PATH = 'static'
\ No newline at end of file
@@ -0,0 +1,28 @@
+"""user versions
+
+Revision ID: 0d4c7b9e2a61
+Revises: f6b2d8e1a7c3
+Create Date: 2026-10-18 15:48:31.602945
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d4c7b9e2a61'
+down_revision = 'f6b2d8e1a7c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        batch_op.add_column(sa.Column('follow_version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('follow_version')
+        batch_op.drop_column('version')
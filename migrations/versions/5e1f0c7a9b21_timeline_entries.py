@@ -0,0 +1,46 @@
+"""timeline entries
+
+Revision ID: 5e1f0c7a9b21
+Revises: 43337e94ce70
+Create Date: 2026-10-18 09:12:44.103512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e1f0c7a9b21'
+down_revision = '43337e94ce70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline_entry',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    with op.batch_alter_table('timeline_entry', schema=None) as batch_op:
+        batch_op.create_index('ix_timeline_entry_user_timestamp', ['user_id', 'timestamp'], unique=False)
+
+    # backfill every reader's timeline from their own and followed posts
+    op.execute(
+        'INSERT INTO timeline_entry (user_id, post_id, timestamp) '
+        'SELECT post.user_id, post.id, post.timestamp FROM post '
+        'WHERE post.user_id IS NOT NULL '
+        'UNION '
+        'SELECT followers.follower_id, post.id, post.timestamp FROM post '
+        'JOIN followers ON followers.followed_id = post.user_id'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('timeline_entry', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_entry_user_timestamp')
+
+    op.drop_table('timeline_entry')
@@ -0,0 +1,32 @@
+"""post like count
+
+Revision ID: 8c3d2a61f4e7
+Revises: 5e1f0c7a9b21
+Create Date: 2026-10-18 10:02:17.558310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3d2a61f4e7'
+down_revision = '5e1f0c7a9b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill from the existing likes
+    op.execute(
+        'UPDATE post SET like_count = '
+        '(SELECT COUNT(*) FROM post_like WHERE post_like.post_id = post.id)'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('like_count')
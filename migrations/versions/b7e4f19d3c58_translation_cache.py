@@ -0,0 +1,38 @@
+"""translation cache
+
+Revision ID: b7e4f19d3c58
+Revises: 8c3d2a61f4e7
+Create Date: 2026-10-18 11:40:05.291877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4f19d3c58'
+down_revision = '8c3d2a61f4e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('translation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('text_hash', sa.String(length=64), nullable=False),
+    sa.Column('source_language', sa.String(length=5), nullable=False),
+    sa.Column('dest_language', sa.String(length=5), nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('text_hash', 'source_language', 'dest_language')
+    )
+    with op.batch_alter_table('translation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_translation_timestamp'), ['timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('translation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_translation_timestamp'))
+
+    op.drop_table('translation')
@@ -0,0 +1,51 @@
+"""unread message count
+
+Revision ID: e3a9c6d2f014
+Revises: b7e4f19d3c58
+Create Date: 2026-10-18 13:12:44.803127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a9c6d2f014'
+down_revision = 'b7e4f19d3c58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_message_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill from the messages received since each user last read them
+    user = sa.table(
+        'user',
+        sa.column('id', sa.Integer),
+        sa.column('last_message_read_time', sa.DateTime),
+        sa.column('unread_message_count', sa.Integer),
+    )
+    message = sa.table(
+        'message',
+        sa.column('recipient_id', sa.Integer),
+        sa.column('timestamp', sa.DateTime),
+    )
+    unread = (
+        sa.select(sa.func.count())
+        .select_from(message)
+        .where(
+            message.c.recipient_id == user.c.id,
+            sa.or_(
+                user.c.last_message_read_time.is_(None),
+                message.c.timestamp > user.c.last_message_read_time,
+            ),
+        )
+        .scalar_subquery()
+    )
+    op.execute(sa.update(user).values(unread_message_count=unread))
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_message_count')
@@ -0,0 +1,60 @@
+"""user social counts
+
+Revision ID: f6b2d8e1a7c3
+Revises: e3a9c6d2f014
+Create Date: 2026-10-18 14:25:09.117364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b2d8e1a7c3'
+down_revision = 'e3a9c6d2f014'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill from the existing posts and follows
+    user = sa.table(
+        'user',
+        sa.column('id', sa.Integer),
+        sa.column('post_count', sa.Integer),
+        sa.column('follower_count', sa.Integer),
+        sa.column('followed_count', sa.Integer),
+    )
+    post = sa.table('post', sa.column('user_id', sa.Integer))
+    followers = sa.table(
+        'followers',
+        sa.column('follower_id', sa.Integer),
+        sa.column('followed_id', sa.Integer),
+    )
+
+    def count(table, column):
+        return (
+            sa.select(sa.func.count())
+            .select_from(table)
+            .where(column == user.c.id)
+            .scalar_subquery()
+        )
+
+    op.execute(
+        sa.update(user).values(
+            post_count=count(post, post.c.user_id),
+            follower_count=count(followers, followers.c.followed_id),
+            followed_count=count(followers, followers.c.follower_id),
+        )
+    )
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('post_count')
@@ -1,13 +1,29 @@
 from datetime import datetime, timedelta
+import os
+import re
+import smtplib
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from io import BytesIO
+from unittest import mock
+from PIL import Image
+from app import cli, create_app, db
+from app.models import User, Post, Message, Translation
+from app.pagination import KeysetPage, encode_cursor
+from app import translate
+from app.services import language_service, profile_picture_service
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     OPENSEARCH_URL = None
+    SEARCH_FTS_PATH = ':memory:'
+    SEARCH_INDEX_ASYNC = False
+    PUBSUB_PATH = ':memory:'
+    PUBSUB_POLL_INTERVAL = 0.05
     
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -29,9 +45,34 @@ class UserModelCase(unittest.TestCase):
 
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
-        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
-                                         'd4c74594d841139328695756648b6bd6'
-                                         '?d=identicon&s=128'))
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), '/static/avatar_placeholder.png')
+            u.uploaded_picture = 'user1'
+            self.assertEqual(u.avatar(128), '/profile_pictures/user1_128.webp')
+            self.assertEqual(u.avatar(70), '/profile_pictures/user1_128.webp')
+            self.assertEqual(u.avatar(1000), '/profile_pictures/user1_256.webp')
+            u.uploaded_picture = 'user1.gif'
+            self.assertEqual(u.avatar(64), '/profile_pictures/user1.gif')
+
+    def test_avatar_upload(self):
+        self.app.root_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.app.root_path, 'static', 'profile_pictures'))
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        upload = BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(upload, 'JPEG')
+        upload.seek(0)
+
+        profile_picture_service.set_uploaded_avatar(u, upload)
+        self.assertRegex(u.uploaded_picture, r'^[0-9a-f]{24}$')
+        for size, filename in zip((64, 128, 256), u.avatar_filenames()):
+            path = profile_picture_service.picture_path(filename)
+            with Image.open(path) as image:
+                self.assertEqual(image.size, (size, size))
+                self.assertEqual(image.format, 'WEBP')
+        with self.assertRaises(ValueError):
+            profile_picture_service.set_uploaded_avatar(u, BytesIO(b'junk'))
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -56,6 +97,166 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_social_counts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p1 = Post(body="post from john", author=u1)
+        db.session.add_all([u1, u2, p1, Post(body="another", author=u1)])
+        db.session.commit()
+        self.assertEqual(u1.post_count, 2)
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count), (1, 1))
+        db.session.delete(p1)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.post_count, 1)
+        self.assertEqual((u1.followed_count, u2.follower_count), (0, 0))
+        self.assertEqual(User.social_count_drift(), [])
+
+        u2.follower_count = 5
+        db.session.commit()
+        drift = User.social_count_drift()
+        self.assertEqual(drift, [(u2.id, (0, 5, 0), (0, 0, 0))])
+        version = u2.version
+        User.repair_social_counts(drift)
+        db.session.commit()
+        self.assertEqual(u2.follower_count, 0)
+        self.assertEqual(u2.version, version + 1)
+
+    def test_api_users_fields_and_ids(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + u1.get_token()}
+        db.session.commit()
+        client = self.app.test_client()
+
+        rv = client.get('/api/users/{}?fields=username'.format(u2.id),
+                        headers=headers)
+        self.assertEqual(rv.get_json(), {'id': u2.id, 'username': 'susan'})
+        rv = client.get('/api/users?ids={},999,{}&fields=username'.format(
+            u2.id, u1.id), headers=headers)
+        self.assertEqual([u['username'] for u in rv.get_json()['items']],
+                         ['susan', 'john'])
+        rv = client.get('/api/users?ids=1,x', headers=headers)
+        self.assertEqual(rv.status_code, 400)
+        rv = client.get('/api/users?per_page=1&fields=username', headers=headers)
+        self.assertIn('fields=username', rv.get_json()['_links']['next'])
+        for per_page in (0, -1):
+            rv = client.get('/api/users?per_page={}&total=1'.format(per_page),
+                            headers=headers)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(len(rv.get_json()['items']), 1)
+            self.assertEqual(rv.get_json()['_meta']['total_pages'], 2)
+
+    def test_api_etags(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + u1.get_token()}
+        db.session.commit()
+        client = self.app.test_client()
+
+        url = '/api/users/{}'.format(u2.id)
+        rv = client.get(url, headers=headers)
+        etag = rv.headers['ETag']
+        rv = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 304)
+        u2.about_me = 'hello'
+        db.session.commit()
+        rv = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.get_json()['about_me'], 'hello')
+
+        url = '/api/users/{}/followers'.format(u2.id)
+        etag = client.get(url, headers=headers).headers['ETag']
+        rv = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 304)
+        u1.follow(u2)
+        db.session.commit()
+        rv = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(len(rv.get_json()['items']), 1)
+        etag = rv.headers['ETag']
+        u1.about_me = 'changed'
+        db.session.commit()
+        rv = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        rv = client.get(url + '?cursor=x', headers=headers)
+        self.assertEqual(len(rv.get_json()['items']), 1)
+        rv = client.get(url + '?page=2', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.get_json()['items'], [])
+
+    def test_token_cache(self):
+        from app.cache import TokenCache
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_token()
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + token}
+        client = self.app.test_client()
+        cache = self.app.token_cache
+        # stands in for the cache of another gunicorn worker
+        other = TokenCache(self.app.pubsub)
+        other.set(other.key(token), (u.id, u.token_expiration))
+
+        self.assertEqual(client.get('/api/users/{}'.format(u.id),
+                                    headers=headers).status_code, 200)
+        self.assertEqual(client.get('/api/users/{}'.format(u.id),
+                                    headers=headers).status_code, 200)
+        self.assertEqual((cache.stats()['misses'], cache.stats()['hits']), (1, 1))
+
+        self.assertEqual(client.delete('/api/tokens', headers=headers).status_code,
+                         204)
+        self.assertEqual(client.get('/api/users/{}'.format(u.id),
+                                    headers=headers).status_code, 401)
+        for _ in range(100):
+            if other.get(other.key(token)) is None:
+                break
+            time.sleep(0.05)
+        self.assertIsNone(other.get(other.key(token)))
+
+    def test_pending_changes_on_rollback(self):
+        db.session.info['stale_tokens'] = {'token'}
+        db.session.begin_nested().rollback()
+        self.assertEqual(db.session.info['stale_tokens'], {'token'})
+        db.session.rollback()
+        self.assertNotIn('stale_tokens', db.session.info)
+
+        # once running, the broker is not locked again for every request
+        broker = self.app.pubsub
+        broker.start()
+        with broker.lock:
+            thread = threading.Thread(target=broker.start)
+            thread.start()
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+
+    def test_token_user_deleted(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_token()
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + token}
+        client = self.app.test_client()
+        cache = self.app.token_cache
+        self.assertEqual(client.get('/api/users/{}'.format(u.id),
+                                    headers=headers).status_code, 200)
+        self.assertIsNotNone(cache.get(cache.key(token)))
+
+        db.session.execute(db.delete(User).where(User.id == u.id))
+        db.session.commit()
+        db.session.expunge_all()
+        rv = client.delete('/api/tokens', headers=headers)
+        self.assertEqual(rv.status_code, 401)
+        self.assertIn('WWW-Authenticate', rv.headers)
+        self.assertIsNone(cache.get(cache.key(token)))
+
     def test_follow_posts(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -90,5 +291,606 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_fan_out(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        p1 = Post(body="post from susan", author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p1])
+        self.assertEqual(u2.followed_posts().all(), [p1])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [])
+
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p1])
+
+        p1.delete_post()
+        self.assertEqual(u1.followed_posts().all(), [])
+        self.assertEqual(u2.followed_posts().all(), [])
+
+        # following yourself is allowed by the model, if not by the routes
+        u2.follow(u2)
+        db.session.commit()
+        p2 = Post(body="another post from susan", author=u2)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(u2.followed_posts().all(), [p2])
+        u2.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u2.followed_posts().all(), [p2])
+
+    def test_follow_list_views(self):
+        self.app.config['POSTS_PER_PAGE'] = 2
+        u = User(username='john', email='john@example.com')
+        others = [User(username='user{}'.format(i),
+                       email='user{}@example.com'.format(i)) for i in range(8)]
+        db.session.add_all([u] + others)
+        db.session.commit()
+        for other in others[:5]:
+            other.follow(u)
+        for other in others[3:6]:
+            u.follow(other)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        def walk(url):
+            names, prev_url = [], None
+            while True:
+                body = client.get(url).get_data(as_text=True)
+                table = body[body.index('<table'):body.index('</table>')]
+                names.append(re.findall(r'href="/user/(\w+)"', table))
+                link = re.search(r'class="next">\s*<a href="([^"#]+)"', body)
+                prev_url = re.search(
+                    r'class="previous">\s*<a href="([^"#]+)"', body)
+                if link is None:
+                    return names, prev_url
+                url = link.group(1)
+
+        pages, prev_url = walk('/user/john/followers')
+        self.assertEqual(pages, [['user4', 'user3'], ['user2', 'user1'],
+                                 ['user0']])
+        body = client.get(prev_url.group(1)).get_data(as_text=True)
+        self.assertIn('href="/user/user1"', body)
+        self.assertNotIn('href="/user/user0"', body)
+        pages, _ = walk('/user/john/following')
+        self.assertEqual(pages, [['user5', 'user4'], ['user3']])
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        posts = [Post(body=str(i), author=u, timestamp=now + timedelta(seconds=i))
+                 for i in range(5)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        columns = [Post.timestamp, Post.id]
+
+        page1 = KeysetPage(Post.query, columns, None, 2)
+        self.assertEqual(page1.items, [posts[4], posts[3]])
+        self.assertFalse(page1.has_prev)
+        page2 = KeysetPage(Post.query, columns, page1.next_cursor, 2)
+        self.assertEqual(page2.items, [posts[2], posts[1]])
+        page3 = KeysetPage(Post.query, columns, page2.next_cursor, 2)
+        self.assertEqual(page3.items, [posts[0]])
+        self.assertFalse(page3.has_next)
+        back = KeysetPage(Post.query, columns, page3.prev_cursor, 2)
+        self.assertEqual(back.items, page2.items)
+        self.assertIsNone(page1.total)
+        self.assertEqual(KeysetPage(Post.query, columns, 'junk', 2).items,
+                         page1.items)
+        for values in ([[1], 1], [{'a': 1}, 1], [now.isoformat(), '1'],
+                       [1, 1], [now.isoformat(), True]):
+            cursor = encode_cursor(values, 'next')
+            self.assertEqual(KeysetPage(Post.query, columns, cursor, 2).items,
+                             page1.items)
+
+    def test_batch_like_state(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p1 = Post(body="post from john", author=u1)
+        p2 = Post(body="post from susan", author=u2)
+        db.session.add_all([u1, u2, p1, p2])
+        db.session.commit()
+        u1.like_post(p2)
+        u2.like_post(p2)
+        db.session.commit()
+
+        self.assertEqual(u1.liked_post_ids([p1, p2]), {p2.id})
+        self.assertEqual(u1.liked_post_ids([]), set())
+
+    def test_like_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p = Post(body="post from john", author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        u1.like_post(p)
+        u2.like_post(p)
+        u2.like_post(p)
+        db.session.commit()
+        self.assertEqual(p.like_count, 2)
+        u1.unlike_post(p)
+        db.session.commit()
+        self.assertEqual(p.like_count, 1)
+        self.assertEqual(Post.like_count_drift(), [])
+
+        p.like_count = 7
+        db.session.commit()
+        drift = Post.like_count_drift()
+        self.assertEqual(drift, [(p.id, 7, 1)])
+        Post.repair_like_counts(drift)
+        db.session.commit()
+        self.assertEqual(p.like_count, 1)
+
+    def test_unread_message_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        for body in ('hi', 'there'):
+            db.session.add(Message(author=u1, recipient=u2, body=body))
+            u2.receive_message()
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count, 2)
+        self.assertEqual(u2.new_messages(), 2)
+        self.assertEqual(User.unread_message_drift(), [])
+        u2.read_messages()
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count, 0)
+
+        u1.unread_message_count = 4
+        db.session.commit()
+        drift = User.unread_message_drift()
+        self.assertEqual(drift, [(u1.id, 4, 0)])
+        User.repair_unread_message_counts(drift)
+        db.session.commit()
+        self.assertEqual(u1.unread_message_count, 0)
+
+    def test_last_seen_buffer(self):
+        buffer = self.app.last_seen
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        start = u.last_seen
+        later = start + timedelta(seconds=30)
+        buffer.record(u, later)
+        self.assertEqual(buffer.flush(), 0)
+
+        later = start + timedelta(minutes=5)
+        buffer.record(u, later)
+        buffer.record(u, later + timedelta(seconds=1))
+        self.assertFalse(u in db.session.dirty)
+        self.assertEqual(buffer.flush(), 1)
+        db.session.refresh(u)
+        self.assertEqual(u.last_seen, later)
+
+        # a stale flush from another worker never moves it backwards
+        buffer.pending[u.id] = start
+        buffer.flush()
+        db.session.refresh(u)
+        self.assertEqual(u.last_seen, later)
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body="the quick brown fox", author=u)
+        p2 = Post(body="a fox, a fox, a fox", author=u)
+        p3 = Post(body="lazy dogs", author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(posts.all(), [p2, p1])
+        posts, total = Post.search('lazy brown', 1, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts.all()), 1)
+
+        p1.body = "slow turtle"
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 0)
+        self.assertEqual(Post.search('"', 1, 10)[1], 0)
+
+    def test_search_cache(self):
+        cache = self.app.search_cache
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body="hello world", author=u)])
+        db.session.commit()
+
+        self.assertEqual(Post.search('Hello', 1, 10)[1], 1)
+        self.assertEqual(Post.search('  hello ', 1, 10)[1], 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        db.session.add(Post(body="hello again", author=u))
+        db.session.commit()
+        self.assertEqual(Post.search('hello', 1, 10)[1], 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # a result computed before an invalidation is never served after it
+        key = cache.key('post', 'hello', 1, 10)
+        cache.invalidate('post')
+        cache.set(key, ([], 0))
+        self.assertEqual(Post.search('hello', 1, 10)[1], 2)
+
+    def test_search_index_queue(self):
+        from app.search import IndexQueue
+        self.app.config.update(SEARCH_INDEX_ASYNC=True, SEARCH_BATCH_SIZE=3,
+                               SEARCH_FLUSH_INTERVAL=1.0)
+        backend = self.app.search_backend
+        calls = []
+
+        class FlakyBackend(object):
+            failures = 1
+
+            def bulk(self, actions):
+                calls.append(len(actions))
+                if self.failures:
+                    self.failures -= 1
+                    raise ConnectionError('search backend unavailable')
+                backend.bulk(actions)
+
+            def query(self, *args):
+                return backend.query(*args)
+
+        self.app.search_backend = FlakyBackend()
+        self.app.search_queue = IndexQueue(self.app, max_retries=2)
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body='fox {}'.format(i), author=u)
+                            for i in range(5)])
+        with mock.patch('app.search._backoff') as backoff:
+            db.session.commit()
+            for _ in range(100):
+                if sum(calls) == 8:
+                    break
+                time.sleep(0.05)
+            # the first batch failed once, was retried, then the rest followed
+            self.assertEqual(calls, [3, 3, 2])
+            self.assertEqual(backoff.call_count, 1)
+            self.assertEqual(Post.search('fox', 1, 10)[1], 5)
+
+            # a batch that keeps failing is dropped after max_retries
+            del calls[:]
+            self.app.search_backend.failures = 3
+            db.session.add(Post(body='fox 5', author=u))
+            db.session.commit()
+            for _ in range(100):
+                if len(calls) == 3:
+                    break
+                time.sleep(0.05)
+            time.sleep(0.1)
+            self.assertEqual(calls, [1, 1, 1])
+        self.assertEqual(Post.search('fox', 1, 10)[1], 5)
+
+    def test_search_reindex(self):
+        cli.register(self.app)
+        indexed = []
+
+        class RecordingBackend(object):
+            fail_at = None
+
+            def bulk(self, actions):
+                if len(indexed) == self.fail_at:
+                    raise ConnectionError('search backend unavailable')
+                indexed.append([action['_id'] for action in actions])
+
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=str(i), author=u) for i in range(7)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        ids = [p.id for p in posts]
+        self.app.search_backend = RecordingBackend()
+
+        # stopping in on_chunk leaves every earlier chunk indexed
+        done = []
+
+        def on_chunk(last_id, size):
+            done.append(last_id)
+            if len(done) == 2:
+                raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            Post.reindex(batch_size=2, on_chunk=on_chunk)
+        self.assertEqual(done, [ids[1], ids[3]])
+        del indexed[:]
+        Post.reindex(done[-1], batch_size=2, on_chunk=lambda *args: None)
+        self.assertEqual(indexed, [ids[4:6], ids[6:]])
+
+        # the command saves a checkpoint per chunk and resumes after it
+        del indexed[:]
+        self.app.search_backend.fail_at = 2
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as instance:
+            self.app.instance_path = instance
+            checkpoint = os.path.join(instance,
+                                      'search-reindex-post.checkpoint')
+            result = runner.invoke(args=['search', 'reindex', '--batch-size',
+                                         '2', '--workers', '1'])
+            self.assertIsInstance(result.exception, ConnectionError)
+            with open(checkpoint) as f:
+                self.assertEqual(int(f.read()), ids[3])
+            self.app.search_backend.fail_at = None
+            result = runner.invoke(args=['search', 'reindex', '--batch-size',
+                                         '2', '--workers', '1'])
+            self.assertIn('resuming after id {}'.format(ids[3]), result.output)
+            self.assertIn('reindex complete: 3 docs', result.output)
+            self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(indexed, [ids[:2], ids[2:4], ids[4:6], ids[6:]])
+
+    def test_mail_queue(self):
+        from app import mail
+        from app.email import MailQueue, send_email
+        connect = mail.connect
+        attempts = []
+
+        def flaky_connect():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionRefusedError()
+            return connect()
+
+        def join(timeout=5):
+            # a dead worker would make join() hang instead of failing
+            deadline = time.monotonic() + timeout
+            while self.app.mail_queue.queue.unfinished_tasks:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            self.app.mail_queue.join()
+
+        with mail.record_messages() as outbox, \
+                mock.patch.object(mail, 'connect', flaky_connect), \
+                mock.patch('app.email._backoff'):
+            for i in range(5):
+                self.assertTrue(send_email('hi {}'.format(i), 'a@example.com',
+                                           ['b@example.com'], 'text', 'html'))
+            join()
+        self.assertEqual(len(outbox), 5)
+        stats = self.app.mail_queue.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['depth']),
+                         (5, 1, 0))
+        self.assertLessEqual(len(attempts), 1 + self.app.config['MAIL_WORKERS'])
+
+        # a login that fails leaves a connection that was never opened
+        from flask_mail import Connection
+        enter = Connection.__enter__
+        enters = []
+
+        def flaky_enter(conn):
+            enters.append(1)
+            if len(enters) == 1:
+                raise smtplib.SMTPAuthenticationError(535, b'no')
+            return enter(conn)
+
+        self.app.mail_queue = MailQueue(self.app)
+        with mail.record_messages() as outbox, \
+                mock.patch.object(Connection, '__enter__', flaky_enter), \
+                mock.patch('app.email._backoff'):
+            self.assertTrue(send_email('hi', 'a@example.com', ['b@example.com'],
+                                       'text', 'html'))
+            join()
+        self.assertEqual(len(outbox), 1)
+        stats = self.app.mail_queue.stats()
+        self.assertEqual((stats['sent'], stats['retries']), (1, 1))
+
+        # an unexpected error is counted and the worker keeps going
+        self.app.mail_queue = MailQueue(self.app)
+        with mail.record_messages() as outbox, \
+                mock.patch.object(self.app.mail_queue, '_send',
+                                  side_effect=KeyError):
+            send_email('hi', 'a@example.com', ['b@example.com'], 'text', 'html')
+            join()
+        self.assertEqual(self.app.mail_queue.stats()['failed'], 1)
+        self.assertTrue(all(t.is_alive()
+                            for t in self.app.mail_queue.threads.threads))
+
+    def test_notification_stream(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        events = self.app.pubsub.subscribe('notifications', u.id)
+        u.add_notification('unread_message_count', 3)
+        db.session.commit()
+        id, payload = events.get(timeout=5)
+        self.assertEqual(payload['name'], 'unread_message_count')
+        self.assertEqual(payload['data'], 3)
+
+        self.app.config['NOTIFICATIONS_STREAM_TIMEOUT'] = 0.2
+        self.app.config['NOTIFICATIONS_HEARTBEAT'] = 0.05
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        rv = client.get('/notifications/stream',
+                        headers={'Last-Event-ID': str(id - 1)})
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        body = rv.get_data(as_text=True)
+        self.assertIn('id: {}\n'.format(id), body)
+        self.assertIn(': keep-alive', body)
+        rv.close()
+
+        # one slot per process here: a busy slot means 503, not a stall
+        self.app.notification_streams = threading.BoundedSemaphore(1)
+        rv = client.get('/notifications/stream')
+        rv.get_data()
+        rv.close()
+        self.assertTrue(self.app.notification_streams.acquire(blocking=False))
+        rv = client.get('/notifications/stream')
+        self.assertEqual(rv.status_code, 503)
+
+    def test_translation_cache(self):
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        response = mock.Mock(status_code=200)
+        response.json.return_value = [{'translations': [{'text': 'hola'}]}]
+        with mock.patch.object(translate, 'http_session') as session:
+            session.return_value.post.return_value = response
+            self.assertEqual(translate.translate('hello', 'en', 'es'), 'hola')
+            self.assertEqual(translate.translate('hello', 'en', 'es'), 'hola')
+            translate.memory_cache().clear()
+            self.assertEqual(translate.translate('hello', 'en', 'es'), 'hola')
+            self.assertEqual(session.return_value.post.call_count, 1)
+
+        # another request inserting the same row first is not an error
+        key = translate.cache_key('hello', 'en', 'es')
+        with mock.patch('flask_sqlalchemy.query.Query.update', return_value=0):
+            translate.store_translation(key, 'hola!')
+        self.assertEqual(translate.memory_cache().get(key), 'hola!')
+        self.assertEqual(Translation.query.count(), 1)
+
+    def test_translate_batch(self):
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        translate.memory_cache().clear()
+        translate.store_translation(translate.cache_key('one', 'en', 'es'), 'uno')
+        response = mock.Mock(status_code=200)
+        response.json.return_value = [{'translations': [{'text': 'dos'}]}]
+        with mock.patch.object(translate, 'http_session') as session:
+            session.return_value.post.return_value = response
+            result = translate.translate_batch(
+                [('one', 'en'), ('two', 'en'), ('two', 'en')], 'es')
+            self.assertEqual(result, ['uno', 'dos', 'dos'])
+            post = session.return_value.post
+            self.assertEqual(post.call_count, 1)
+            self.assertEqual(post.call_args.kwargs['json'], [{'Text': 'two'}])
+
+    def test_translate_batch_validation(self):
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        for payload in ({'post_ids': 5}, {'post_ids': '123'},
+                        {'post_ids': [1, 'x']},
+                        {'post_ids': [1], 'dest_language': 'toolong'}):
+            rv = client.post('/translate/batch', json=payload)
+            self.assertEqual(rv.status_code, 400, payload)
+        rv = client.post('/translate/batch',
+                         json={'post_ids': [], 'dest_language': 'en'})
+        self.assertEqual(rv.get_json(), {'translations': {}})
+
+    def test_detect_language(self):
+        detect = language_service.detect_language
+        self.assertEqual(detect('hi'), '')
+        self.assertEqual(detect('hello there, friends'), 'en')
+        self.assertEqual(detect('안녕하세요 여러분, 반갑습니다'), 'ko')
+        self.assertEqual(detect('ceci est un message en francais'), 'en')
+        self.app.config['LANGUAGE_ASCII_DEFAULT'] = None
+        self.assertEqual(detect('ceci est un message en francais'), 'fr')
+
+    def test_detect_language_backfill(self):
+        cli.register(self.app)
+        u = User(username='john', email='john@example.com')
+        korean = '안녕하세요 여러분, 반갑습니다'
+        english = 'hello there, friends'
+        posts = [Post(body=korean, author=u),
+                 Post(body=korean, author=u, language=''),
+                 Post(body='hi', author=u),
+                 Post(body=english, author=u, language='fr'),
+                 Post(body=english, author=u),
+                 Post(body=english, author=u, language='')]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        ids = [p.id for p in posts]
+        args = ['posts', 'detect-language', '--chunk-size', '2',
+                '--workers', '1']
+        runner = self.app.test_cli_runner()
+
+        def languages():
+            db.session.expire_all()
+            return [db.session.get(Post, id).language for id in ids]
+
+        with tempfile.TemporaryDirectory() as instance:
+            self.app.instance_path = instance
+            checkpoint = os.path.join(instance,
+                                      'posts-detect-language.checkpoint')
+            # stop after the second chunk has been written
+            with mock.patch('app.cli.click.echo',
+                            side_effect=[None, RuntimeError('stopped')]):
+                result = runner.invoke(args=args)
+            self.assertIsInstance(result.exception, RuntimeError)
+            with open(checkpoint) as f:
+                self.assertEqual(int(f.read()), ids[4])
+            self.assertEqual(languages(), ['ko', 'ko', '', 'fr', 'en', ''])
+
+            result = runner.invoke(args=args)
+            self.assertIn('resuming after id {}'.format(ids[4]), result.output)
+            self.assertIn('complete: 1 posts', result.output)
+            self.assertFalse(os.path.exists(checkpoint))
+            self.assertEqual(languages(), ['ko', 'ko', '', 'fr', 'en', 'en'])
+
+            result = runner.invoke(args=args + ['--skip-undetected'])
+            self.assertIn('complete: 0 posts', result.output)
+            result = runner.invoke(args=args)
+            self.assertIn('complete: 1 posts', result.output)
+
+    def test_provision_missing_avatars(self):
+        self.app.root_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.app.root_path, 'static', 'profile_pictures'))
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertIsNone(u1.uploaded_picture)
+        version = u1.version
+
+        self.assertEqual(
+            profile_picture_service.provision_missing_avatars(2), (2, 0))
+        self.assertEqual(u1.version, version + 1)
+        self.assertRegex(u1.uploaded_picture, r'^[0-9a-f]{24}$')
+        self.assertNotEqual(u1.uploaded_picture, u2.uploaded_picture)
+        self.assertTrue(profile_picture_service.has_image(u2))
+
+    def test_avatar_caching(self):
+        self.app.root_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.app.root_path, 'static', 'profile_pictures'))
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        upload = BytesIO()
+        Image.new('RGB', (300, 300), 'red').save(upload, 'PNG')
+        upload.seek(0)
+        profile_picture_service.set_uploaded_avatar(u, upload)
+        db.session.commit()
+        first = u.uploaded_picture
+        upload.seek(0)
+        profile_picture_service.set_uploaded_avatar(u, upload)
+        self.assertEqual(u.uploaded_picture, first)
+
+        client = self.app.test_client()
+        with client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(u.id)
+            url = '/profile_pictures/{}_64.webp'.format(first)
+            rv = client.get(url)
+            self.assertEqual(rv.status_code, 200)
+            self.assertTrue(rv.cache_control.immutable)
+            self.assertEqual(rv.cache_control.max_age, 365 * 24 * 3600)
+            self.assertIsNotNone(rv.headers.get('ETag'))
+            self.assertIsNotNone(rv.headers.get('Last-Modified'))
+            rv = client.get(url, headers={'If-None-Match': rv.headers['ETag']})
+            self.assertEqual(rv.status_code, 304)
+
+            self.app.config['AVATAR_X_ACCEL_PREFIX'] = '/_protected'
+            rv = client.get(url)
+            self.assertEqual(rv.headers['X-Accel-Redirect'],
+                             '/_protected/{}_64.webp'.format(first))
+            self.assertEqual(rv.data, b'')
+
+    def test_identicon(self):
+        render = profile_picture_service.render_identicon
+        a = render('d4c74594d841139328695756648b6bd6', 64)
+        self.assertTrue(a.startswith(b'\x89PNG\r\n\x1a\n'))
+        self.assertEqual(a, render('d4c74594d841139328695756648b6bd6', 64))
+        self.assertNotEqual(a, render('0cc175b9c0f1b6a831c399e269772661', 64))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)